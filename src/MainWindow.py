@@ -31,21 +31,49 @@ from PyQt4.QtCore import *
 
 # UI components
 from view.mwUi import Ui_MainWindow
-from view.Dialogs import searchDialog
 from view.Dialogs import syncDialog
 from view.Dialogs import commitDialog
 from view.Dialogs import notRoot
 
 from view.Changes import ChangeWin
+from view.PackageModel import PackageModel, PackageRow, NAME, CHECK
 
 # Package management
 from model.Transaction import Transaction
+from model import Progress
+from model import Cancel
 
 # General Python Libraries
-import os, sys, time
+import os, sys, time, re
 import string
 import shlex, subprocess
 
+# Milliseconds search results are collected before they are shown
+RESULTINTERVAL = 50
+
+# Milliseconds typing has to pause before a search starts
+SEARCHDELAY = 250
+
+# Shortest term searched for, the AUR refuses shorter ones
+MINTERMLENGTH = 2
+
+# Terms both backends match as a plain substring. The results for such a
+# term are a subset of the results for any term it extends.
+PLAINTERM = re.compile(r'^[\w-]+$')
+
+
+def matchesTerm(app, term):
+    """Returns True if a search result matches term the way the backends
+    match it: in the name, the description or (repos only) the provides.
+    :param app: Package dictionary.
+    :param term: Lower case search term.
+    """
+    if term in app['Name'].lower() or \
+       term in (app.get('Description') or '').lower():
+        return True
+    return any(term in p.lower() for p in app.get('provides', ()))
+
+
 class Main(QMainWindow):
     """The main window of the application.
     :param QMainWindow: A Qt parent class for Main Windows.
@@ -61,17 +89,26 @@ class Main(QMainWindow):
 
         self.ui=Ui_MainWindow()
         self.ui.setupUi(self)
+        self.model = PackageModel(self)
+        self.ui.queryList.setModel(self.model)
+        self.ui.queryList.sortByColumn(NAME, Qt.AscendingOrder)
+        self.pendingRows = []
+        self.q = None
+        self.queries = set()
+        self.resultTimer = QTimer(self)
+        self.resultTimer.setSingleShot(True)
+        self.searchTimer = QTimer(self)
+        self.searchTimer.setSingleShot(True)
+        # Results of the last search and the term they are complete for
+        self.searchResults = []
+        self.searchTerm = None
+        self.shownTerm = None
         self.makeConnections()
 
         self.installList = {}
         self.upgradeList = {}
         self.removeList = {}
 
-        self.changeFont = QFont()
-        self.changeFont.setBold(True)
-        self.Font = QFont()
-        self.Font.setBold(False)
-
         t = Transaction()
         self.installed = t.getInstalled()
         self.upgrades = {}
@@ -89,99 +126,94 @@ class Main(QMainWindow):
         QObject.connect(self.ui.actionUpgrade, SIGNAL('triggered()'), self.markUpgrades)
         QObject.connect(self.ui.applyButton, SIGNAL('clicked()'), self.applyChanges)
         QObject.connect(self.ui.quitButton, SIGNAL('clicked()'), self.checkQuit)
-        QObject.connect(self.ui.queryList, SIGNAL('itemSelectionChanged()'), self.handleChanges)
-
-
-    def handleChanges(self):
-        """Updates the list of packages when a checkbox is (un)checked.
-        """
-        it = QTreeWidgetItemIterator(self.ui.queryList)
-        while it.value():
-            appName = str(it.value().text(2))
-            if it.value().checkState(0):
-                if appName not in self.installed and appName not in self.upgradeList:
-                    # set bold
-                    it.value().setFont(1, self.changeFont)
-                    it.value().setFont(2, self.changeFont)
-                    it.value().setFont(3, self.changeFont)
-                    # add to installList
+        QObject.connect(self.model, SIGNAL('dataChanged(QModelIndex,QModelIndex)'),
+                        self.handleChanges)
+        QObject.connect(self.resultTimer, SIGNAL('timeout()'), self.flushResults)
+        QObject.connect(self.ui.queryEdit, SIGNAL('textChanged(QString)'),
+                        self.scheduleSearch)
+        QObject.connect(self.searchTimer, SIGNAL('timeout()'), self.newSearch)
+
+
+    def handleChanges(self, topLeft, bottomRight):
+        """Updates the change sets when checkboxes are (un)checked.
+        Connected to the model's dataChanged, so only the rows whose check
+        state changed are looked at.
+        """
+        if topLeft.column() > CHECK:
+            # Only the styling of rows changed
+            return
+        for row in range(topLeft.row(), bottomRight.row() + 1):
+            self.handleChange(row)
+
+
+    def handleChange(self, row):
+        """Updates the change sets for one row and restyles it.
+        :param row: Row number in the model.
+        """
+        r = self.model.rows[row]
+        appName = r.name
+        if r.checked:
+            if appName not in self.installed and appName not in self.upgradeList:
+                # add to installList
+                if appName not in self.installList:
                     newInstall = {}
-                    newInstall['Checked'] = it.value().checkState(0)
-                    newInstall['repo'] = str(it.value().text(1))
-                    newInstall['Name'] = str(it.value().text(2))
-                    newInstall['Description'] = str(it.value().text(3))
-                    if appName not in self.installList:
-                        self.installList[appName] = newInstall
-                elif appName in self.upgradeList:
-                    it.value().setFont(1, self.changeFont)
-                    it.value().setFont(2, self.changeFont)
-                    it.value().setFont(3, self.changeFont)
-                else:
-                    it.value().setFont(1, self.Font)
-                    it.value().setFont(2, self.Font)
-                    it.value().setFont(3, self.Font)
-                    if appName in self.removeList:
-                        self.removeList.pop(appName)
+                    newInstall['Checked'] = Qt.Checked
+                    newInstall['repo'] = r.repo
+                    newInstall['Name'] = r.name
+                    newInstall['Description'] = r.description
+                    self.installList[appName] = newInstall
+                self.model.setChanged(row, True)
+            elif appName in self.upgradeList:
+                self.model.setChanged(row, True)
             else:
-                if appName in self.installed and appName not in self.upgradeList:
-                    # set bold
-                    it.value().setFont(1, self.changeFont)
-                    it.value().setFont(2, self.changeFont)
-                    it.value().setFont(3, self.changeFont)
-                    # add to removeList 
+                self.removeList.pop(appName, None)
+                self.model.setChanged(row, False)
+        else:
+            if appName in self.installed and appName not in self.upgradeList:
+                # add to removeList 
+                if appName not in self.removeList:
                     newRemove = {}
-                    newRemove['Checked'] = it.value().checkState(0)
-                    newRemove['repo'] = str(it.value().text(1))
-                    newRemove['Name'] = str(it.value().text(2))
-                    newRemove['Description'] = str(it.value().text(3))
-                    if appName not in self.removeList:
-                        self.removeList[appName] = newRemove
-                elif appName in self.upgradeList:
-                    it.value().setFont(1, self.Font)
-                    it.value().setFont(2, self.Font)
-                    it.value().setFont(3, self.Font)
-                    self.upgradeList.pop(appName)
-                    if appName in self.installed:
-                        it.value().setCheckState(0, Qt.Checked)
-                else:
-                    it.value().setFont(1, self.Font)
-                    it.value().setFont(2, self.Font)
-                    it.value().setFont(3, self.Font)
-                    if appName in self.installList:
-                        self.installList.pop(appName)
-            it += 1
+                    newRemove['Checked'] = Qt.Unchecked
+                    newRemove['repo'] = r.repo
+                    newRemove['Name'] = r.name
+                    newRemove['Description'] = r.description
+                    self.removeList[appName] = newRemove
+                self.model.setChanged(row, True)
+            elif appName in self.upgradeList:
+                self.upgradeList.pop(appName)
+                self.model.setChanged(row, False)
+                if appName in self.installed:
+                    self.model.setData(self.model.index(row, CHECK), Qt.Checked,
+                                       Qt.CheckStateRole)
+            else:
+                self.installList.pop(appName, None)
+                self.model.setChanged(row, False)
+
+
+    def makeRow(self, app):
+        """Returns the PackageRow of a package, showing changes already
+        marked for it.
+        :param app: Package dictionary with repo, Name and Description.
+        """
+        name = app['Name']
+        changed = name in self.installList or name in self.upgradeList or \
+                  name in self.removeList
+        if changed:
+            checked = name not in self.removeList
+        else:
+            checked = name in self.installed
+        return PackageRow(app['repo'], name, app['Description'], checked, changed)
 
 
     def viewChanges(self):
         """Displays the list of packages that have been selected to change
         state.
         """
-        self.ui.queryList.clear()
-        for app in list(self.installList.values()):
-            item = QTreeWidgetItem([' ', app['repo'], 
-                                    app['Name'], app['Description']])
-            item.setCheckState(0,Qt.Checked)
-            item.setFont(1, self.changeFont)
-            item.setFont(2, self.changeFont)
-            item.setFont(3, self.changeFont)
-            self.ui.queryList.addTopLevelItem(item)
-        for app in list(self.upgradeList.values()):
-            item = QTreeWidgetItem([' ', app['repo'], 
-                                    app['Name'], app['Description']])
-            item.setCheckState(0,Qt.Checked)
-            item.setFont(1, self.changeFont)
-            item.setFont(2, self.changeFont)
-            item.setFont(3, self.changeFont)
-            self.ui.queryList.addTopLevelItem(item)
-        for app in list(self.removeList.values()):
-            item = QTreeWidgetItem([' ', app['repo'], 
-                                    app['Name'], app['Description']])
-            item.setCheckState(0,Qt.Unchecked)
-            item.setFont(1, self.changeFont)
-            item.setFont(2, self.changeFont)
-            item.setFont(3, self.changeFont)
-            self.ui.queryList.addTopLevelItem(item)
-        self.ui.queryList.sortItems(2, Qt.AscendingOrder)
+        apps = list(self.installList.values()) + \
+               list(self.upgradeList.values()) + list(self.removeList.values())
+        self.cancelSearch()
+        self.shownTerm = None
+        self.model.setRows([self.makeRow(app) for app in apps])
 
 
     def markUpgrades(self):
@@ -198,32 +230,69 @@ class Main(QMainWindow):
                 
 
 
-    def clearChanges(self):
+    def clearChanges(self, keep=()):
         """Clears all changes that have not been commited.
+        :param keep: Names of packages whose changes stay marked; they are
+                     shown in the list.
         """
-        self.ui.queryList.clear()
-        self.installList.clear()
-        self.removeList.clear()
-        self.upgradeList.clear()
+        self.cancelSearch()
+        self.shownTerm = None
+        self.model.clear()
+        for changes in (self.installList, self.removeList, self.upgradeList):
+            for name in list(changes):
+                if name not in keep:
+                    del changes[name]
         t = Transaction()
         self.installed = t.getInstalled()
         self.upgrades = {}
-        self.handleChanges()
+        if keep:
+            self.viewChanges()
+
 
 
+    def scheduleSearch(self, text):
+        """Starts a search once typing pauses for SEARCHDELAY.
+        :param text: Current contents of queryEdit.
+        """
+        self.searchTimer.start(SEARCHDELAY)
+
 
     def newSearch(self):
-        """Brings up a dialog while searching occurs.
+        """Searches for the term in queryEdit. A term extending the one the
+        shown results are for is answered by filtering those results.
         """
-        self.busy = searchDialog(self)
-        self.ui.queryList.clear()
+        self.searchTimer.stop()
+        term = str(self.ui.queryEdit.text()).strip()
+        if term == self.shownTerm:
+            return
+        self.cancelSearch()
+        self.shownTerm = term
+        if len(term) < MINTERMLENGTH:
+            self.model.clear()
+            self.searchResults = []
+            self.searchTerm = None
+            return
 
-        self.busy.show()
-        self.busy.setValue(0)
+        if self.searchTerm is not None and term.startswith(self.searchTerm) \
+           and PLAINTERM.match(term):
+            lowered = term.lower()
+            self.searchResults = [q for q in self.searchResults
+                                  if matchesTerm(q, lowered)]
+            self.searchTerm = term
+            self.model.setRows([self.makeRow(q) for q in self.searchResults])
+            self.selectMatch(term)
+            return
 
-        self.q = runQuery(self)
+        self.model.clear()
+        self.searchResults = []
+        self.searchTerm = None
+        self.ui.statusBar.showMessage('Searching...')
+        self.q = runQuery(self, term)
+        self.connect(self.q, SIGNAL("results(PyQt_PyObject)"), self.queueResults)
         self.connect(self.q, SIGNAL("update(PyQt_PyObject)"), self.displaySearch)
-        self.connect(self.busy, SIGNAL("canceled()"), self.cancelSearch)
+        self.connect(self.q, SIGNAL("finished()"), self.queryFinished)
+        # Keep the thread referenced until it ends, even if it is replaced
+        self.queries.add(self.q)
         self.q.begin()
 
 
@@ -240,15 +309,16 @@ class Main(QMainWindow):
         self.sync.setValue(0)
 
         self.thread = runSync(self)
-        self.connect(self.thread, SIGNAL("canceled()"), self.cancelSync)
+        self.connect(self.sync, SIGNAL("canceled()"), self.cancelSync)
         self.connect(self.thread, SIGNAL("finished()"), self.finishSync)
         self.thread.begin()
 
 
     def cancelSync(self):
-        """Cancels sync operation.
+        """Cancels sync operation. pacman is interrupted and the thread
+        ends on its own shortly after.
         """
-        self.thread.terminate()
+        self.thread.cancel()
         self.sync.hide()
 
     def finishSync(self):
@@ -257,32 +327,75 @@ class Main(QMainWindow):
         self.sync.hide()
 
 
+    def queueResults(self, results):
+        """Queues the results of one search backend. They are added to the
+        list together with whatever else arrives within RESULTINTERVAL.
+        :param results: List of package dictionaries.
+        """
+        if self.sender() is not self.q:
+            # A search that has since been replaced or cancelled
+            return
+        self.searchResults += results
+        self.pendingRows += [self.makeRow(q) for q in results]
+        if not self.resultTimer.isActive():
+            self.resultTimer.start(RESULTINTERVAL)
+
+
+    def flushResults(self):
+        """Adds the queued search results to the list.
+        """
+        self.resultTimer.stop()
+        if self.pendingRows:
+            self.model.appendRows(self.pendingRows)
+            self.pendingRows = []
+
+
     # contributions by Greg Haynes
     def displaySearch(self, transaction):
-        """Displays the results of a search operation.
+        """Finishes a search operation once all backends answered.
         :param transaction: A transaction initiated for searching.
         """
-        response = transaction.queryResult
-        found_exact_match = False
-        for q in response:
-            item = QTreeWidgetItem([' ', q['repo'], 
-                                    q['Name'], q['Description']])
-            if q['Installed'] == True:
-                item.setCheckState(0,Qt.Checked)
-            else:
-                item.setCheckState(0,Qt.Unchecked)
-            self.ui.queryList.addTopLevelItem(item)
-            if not found_exact_match and q['Name'].capitalize() == transaction.query_string.capitalize():
-                item.setSelected(True)
-        self.ui.queryList.sortItems(2, Qt.AscendingOrder)
-        self.busy.hide()
+        if self.sender() is not self.q:
+            return
+        self.flushResults()
+        if transaction.errors:
+            # Incomplete results must not be refined locally
+            self.searchTerm = None
+            self.ui.statusBar.showMessage('Search incomplete: ' +
+                                          str(transaction.errors[0]))
+        else:
+            self.searchTerm = transaction.query_string
+            self.ui.statusBar.clearMessage()
+        self.selectMatch(transaction.query_string)
+        self.q = None
+
+
+    def selectMatch(self, term):
+        """Selects the package named term, if it is in the list.
+        """
+        row = self.model.findName(term, caseSensitive=False)
+        if row >= 0:
+            index = self.model.index(row, NAME)
+            self.ui.queryList.selectionModel().select(index,
+                QItemSelectionModel.Select | QItemSelectionModel.Rows)
+            self.ui.queryList.scrollTo(index)
+
+
+    def queryFinished(self):
+        """Forgets a search thread that ended.
+        """
+        self.queries.discard(self.sender())
 
 
     def cancelSearch(self):
-        """Cancels search and returns user to Main window.
+        """Cancels the running search, its results are ignored.
         """
-        self.q.terminate()
+        if self.q is not None:
+            self.q.cancel()
         self.q = None
+        self.pendingRows = []
+        self.resultTimer.stop()
+        self.ui.statusBar.clearMessage()
 
 
     def applyChanges(self):
@@ -292,7 +405,7 @@ class Main(QMainWindow):
             self.notroot = notRoot(self)
             QMessageBox.open(self.notroot)
             return
-        self.handleChanges()
+        # The change sets are kept up to date through dataChanged
         t = Transaction()
         changes = t.changeList(self.installList, self.upgradeList, self.removeList)
         self.cWin = ChangeWin(self)
@@ -308,61 +421,34 @@ class Main(QMainWindow):
          
 
     def commitChanges(self):
-        """If changes were accepted they are commited.
+        """If changes were accepted they are commited, on a separate thread
+        reporting its progress to the commit dialog.
         """
-        tLen = len(self.installList) + len(self.upgradeList) + len(self.removeList)
         self.commitWin = commitDialog(self)
         self.commitWin.show()
         self.commitWin.setValue(0)
-        if len(self.removeList) > 0:
-            self.commitWin.setLabel(QLabel(str('Removing Packages')))
-            self.commitRemoves()
-        if len(self.upgradeList) > 0:
-            self.commitWin.setLabel(QLabel(str('Upgrading Packages')))
-            self.commitUpgrades()
-        if len(self.installList) > 0:
-            self.commitWin.setLabel(QLabel(str('Installing Packages')))
-            self.commitInstalls()
-        self.commitWin.hide()
-        self.clearChanges()
 
-
-    def commitRemoves(self):
-        """Removes programs marked as such.
-        """
-        for app in self.removeList.values():
-            try:
-                self.commitWin.setLabel(QLabel(str('Removing ' + app['Name'])))
-                trans = Transaction()
-                trans.remove(app)
-            except:
-                pass
+        self.commitThread = runCommit(self)
+        self.connect(self.commitThread, SIGNAL("progress(PyQt_PyObject)"),
+                     self.commitWin.showProgress)
+        self.connect(self.commitThread, SIGNAL("finished()"), self.finishCommit)
+        self.commitThread.begin()
 
 
-    def commitUpgrades(self):
-        """Upgrades programs marked as such.
+    def finishCommit(self):
+        """Hides the commit dialog once all changes are commited. Errors
+        are reported, and the changes that failed stay marked.
         """
-        for app in self.upgradeList.values():
-            try:
-                self.commitWin.setLabel(QLabel(str('Upgrading ' + app['Name'])))
-                trans = Transaction()
-                trans.upgrade(app)
-            except:
-                pass
+        self.commitWin.hide()
+        t = self.commitThread.t
+        self.commitThread = None
+        if t.errors:
+            QMessageBox.warning(self, 'Commiting Changes',
+                                'Some changes could not be commited:\n\n' +
+                                '\n'.join(str(e) for e in t.errors))
+        self.clearChanges(keep=t.failed)
 
 
-    def commitInstalls(self):
-        """Installs programs marked as such.
-        """
-        for app in self.installList.values():
-            self.commitWin.setLabel(QLabel(str('Installing ' + app['Name'])))
-            trans = Transaction()
-            try:
-                trans.upgrade(app)
-            except:
-                pass
-        
-        
     def checkQuit(self):
         """Exit the application.
         """
@@ -372,24 +458,36 @@ class Main(QMainWindow):
 
 
 class runQuery(QThread):
-    """Emits update(Transaction()) when complete.
+    """Emits results(list) for the results of each backend as it answers,
+    and update(Transaction()) when complete.
     :Param QThread: Parent class.
     """
 
 
-    def __init__(self, mw):
+    def __init__(self, mw, term):
         QThread.__init__(self)
         self.mw = mw
+        self.term = term
+        self.t = Transaction()
 
 
     def run(self):
         """Runs query in a seperate thread.
         """
-        self.t = Transaction()
-        self.t.query_string = str(self.mw.ui.queryEdit.text())
-        self.t.query(self.t.query_string)
+        self.t.query_string = self.term
+        self.t.streamQuery(self.t.query_string, self.sendResults)
         self.emit(SIGNAL('update(PyQt_PyObject)'), self.t)
         return
+
+
+    def cancel(self):
+        """Aborts the backend calls of the query, from the GUI thread.
+        """
+        self.t.cancel()
+
+
+    def sendResults(self, results):
+        self.emit(SIGNAL('results(PyQt_PyObject)'), results)
         
 
     def begin(self):
@@ -400,6 +498,53 @@ class runQuery(QThread):
 
 
 
+class runCommit(QThread):
+    """Thread commiting the marked changes.
+    Emits progress(Progress.Event), at most every Progress.INTERVAL seconds.
+    :param QThread: Parent class.
+    """
+
+
+    def __init__(self, mw):
+        """Initialize new commit thread.
+        :param mw: MainWindow that created this class.
+        """
+        QThread.__init__(self)
+        self.installList = dict(mw.installList)
+        self.upgradeList = dict(mw.upgradeList)
+        self.removeList = dict(mw.removeList)
+        self.t = Transaction()
+
+
+    def run(self):
+        """Run commit thread.
+        """
+        throttle = Progress.Throttle(self.sendProgress)
+        try:
+            plan = self.t.planCommit(self.installList, self.upgradeList,
+                                     self.removeList)
+            self.t.commit(plan, throttle)
+        except Exception as e:
+            # Nothing was commited
+            self.t.errors.append(e)
+            self.t.failed |= set(self.installList) | set(self.upgradeList) | \
+                             set(self.removeList)
+        throttle.flush()
+        return
+
+
+    def sendProgress(self, event):
+        self.emit(SIGNAL('progress(PyQt_PyObject)'), event)
+
+
+    def begin(self):
+        """Begin new Thread.
+        """
+        self.start()
+
+
+
+
 class runSync(QThread):
     """Thread for syncing the package database.
     :param QThread: Parent class.
@@ -412,16 +557,25 @@ class runSync(QThread):
         """
         QThread.__init__(self)
         self.mw = mw
+        self.t = Transaction()
 
 
     def run(self):
         """Run sync thread.
         """
-        self.t = Transaction()
-        self.t.sync()
+        try:
+            self.t.sync()
+        except Cancel.CancelledError:
+            pass
         return
 
 
+    def cancel(self):
+        """Interrupts pacman, from the GUI thread.
+        """
+        self.t.cancel()
+
+
     def begin(self):
         """Begin new Thread.
         """
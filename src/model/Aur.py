@@ -24,23 +24,126 @@
 
 import sys
 import os
+import pwd
 import json
-import urllib.request, urllib.parse, urllib.error
+import urllib.parse
 import stat
-import subprocess
+import threading
+
+from . import Pacman
+from . import Vercmp
+from . import Http
+from . import Workers
+from . import Cache
+from . import AurMirror
+from . import Srcinfo
+from . import BashPool
+from . import Workspace
+from . import PackageCache
+from . import SourceCache
+from . import Cancel
+
+AURURL = 'https://aur.archlinux.org'
+
+# Keep multiinfo requests well below common server URL length limits
+MAXURLLENGTH = 4000
+
+# Settings of the shared AUR HTTP client
+POOLSIZE = 8
+TIMEOUT = 30
+
+# Maximum number of AUR requests run in parallel
+WORKERS = POOLSIZE
+
+# Serve RPC responses from the on-disk cache when possible
+USECACHE = True
+
+# Answer searches and info lookups from the offline mirror while it is
+# fresh, see AurMirror.MAXAGE
+USEMIRROR = True
+
+# Reuse packages built earlier from identical build files
+USEPKGCACHE = True
+
+# Fetch upstream sources through the shared source cache
+USESRCCACHE = True
+
+# Unprivileged user makepkg runs as when potluck runs as root, which
+# makepkg refuses: $POTLUCK_BUILDUSER, else the user who started sudo
+BUILDUSER = os.environ.get('POTLUCK_BUILDUSER') or os.environ.get('SUDO_USER')
+
+class AurError(Exception):
+    """Exception that is raised when the AUR RPC answers with an error.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+
+
+def decodeRpc(value):
+    """Returns the decoded JSON of an RPC reply.
+    :param value: Raw reply body.
+    The RPC reports some failures, such as too many search results, in
+    an otherwise normal reply; those raise AurError.
+    """
+    jsonValue = json.loads(value.decode("utf-8"))
+    if jsonValue.get('type') == 'error':
+        raise AurError(jsonValue.get('error') or 'AUR RPC error')
+    return jsonValue
+
+
+_client = None
+_clientLock = threading.Lock()
+
+def getClient():
+    """Returns the keep-alive HTTP client used for all AUR traffic.
+    """
+    global _client
+    with _clientLock:
+        if _client is None:
+            _client = Http.Client(poolSize=POOLSIZE, timeout=TIMEOUT)
+        return _client
+
+
+def rpc(url, endpoint, token=None):
+    """Returns the body of an AUR RPC request.
+    :param url: Full RPC URL.
+    :param endpoint: RPC type (search, info, multiinfo), selects the TTL.
+    :param token: Cancel.CancelToken aborting the request.
+    """
+    if USECACHE:
+        return Cache.getCache().get(url, endpoint, getClient(), token)
+    return getClient().get(url, token=token)
+
+
+def getMirror():
+    """Returns the offline AUR mirror, or None if it is disabled, has not
+    been built or is older than AurMirror.MAXAGE.
+    """
+    if not USEMIRROR:
+        return None
+    mirror = AurMirror.getMirror()
+    if mirror.available():
+        return mirror
+    return None
 
-AURURL = 'http://aur.archlinux.org'
 
 class Query:
     """Searches the AUR using the scripting API"""
 
 
-    def __init__(self, term):
+    def __init__(self, term, token=None):
         """Initializes an AUR query.
         :param term: key phrase to search for.
+        :param token: Cancel.CancelToken aborting the request.
         """
-        self.AURURL = 'http://aur.archlinux.org/rpc.php?type=search&arg='
+        self.AURURL = AURURL + '/rpc.php?type=search&arg='
         self.query = []
+        self.token = token
         self.search(term)
 
 
@@ -48,16 +151,21 @@ class Query:
         """Search fhe AUR.
         :param term: keyword to search for.
         """
-        queryURL = self.AURURL + term
-        value = urllib.request.urlopen(queryURL).read()
-        self.decodeResponse(value.decode("utf-8"))
+        mirror = getMirror()
+        if mirror is not None:
+            self.query = mirror.search(term)
+            return
+        queryURL = self.AURURL + urllib.parse.quote(term, safe='')
+        value = rpc(queryURL, 'search', self.token)
+        self.decodeResponse(value)
         
 
     def decodeResponse(self, value):
         """Decodes JSON from AUR query.
         :param value: raw JSON input.
+        Raises AurError if the AUR reports an error.
         """
-        jsonValue = json.loads(value)
+        jsonValue = decodeRpc(value)
         self.query = jsonValue['results']
 
 
@@ -77,24 +185,44 @@ class Upgrade:
     """
 
 
-    def __init__(self, target):
+    def __init__(self, target, workspace=None, token=None):
         """Initializes an upgrade object
         :param target: Application to upgrade.
+        :param workspace: Workspace.Workspace to download and build in, a
+                          new one under Workspace.ROOT if None.
+        :param token: Cancel.CancelToken aborting downloads and makepkg.
         """
         self.target = target
+        self.token = token
+        if workspace is None:
+            workspace = Workspace.Workspace(target)
+        self.workspace = workspace
+        self.path = workspace.path
+        # True once makePkg took the packages from the package cache
+        self.cached = False
+        self.sourcesFetched = False
+        self.srcinfo = None
         self.downloadPkgbuild()
-        if not os.path.exists(target):
-            os.makedirs(target)
+        # Taken before any source lands in the workspace
+        self.buildKey = PackageCache.buildKey(self.path)
+        self.metadata = self.getMetadata()
+        # The build key cannot tell which revision VCS sources check out
+        self.cacheable = USEPKGCACHE and self.srcinfo is not None and \
+                         not Srcinfo.hasVcsSources(self.srcinfo)
         self.buildDepends = self.getBuildDepends()
         self.depends = self.getDepends()
+        self.conflicts = self.metadata['conflicts']
+        self.provides = self.metadata['provides']
+        self.replaces = self.metadata['replaces']
 
 
     def downloadPkgbuild(self):
         """Downloads the PKGBUILD associated with a package.
         """
-        self.AURURL = 'http://aur.archlinux.org'
+        self.AURURL = AURURL
         self.getPkgInfo()
         self.getPkgbuild()
+        self.getSrcinfo()
 
 
     def getPkgInfo(self):
@@ -102,16 +230,17 @@ class Upgrade:
         """
         AURSearchURL = self.AURURL + '/rpc.php?type=info&arg='
         self.info = []
-        infoURL = AURSearchURL + self.target
+        infoURL = AURSearchURL + urllib.parse.quote(self.target, safe='')
 
-        value = urllib.request.urlopen(infoURL).read()
-        self.decodeResponse(value.decode("utf-8"))
+        value = rpc(infoURL, 'info', self.token)
+        self.decodeResponse(value)
 
 
     def decodeResponse(self, value):
         """Decodes JSON response from AUR.
+        Raises AurError if the AUR reports an error.
         """
-        self.info = json.loads(value)
+        self.info = decodeRpc(value)
         response = self.info['results']
         self.pkgURL = self.AURURL + response['URLPath']
 
@@ -119,97 +248,243 @@ class Upgrade:
     def getPkgbuild(self):
         """Downloads PKGBUILD file.
         """
-        if not os.path.exists(self.target):
-            os.makedirs(self.target)
-        os.chdir(self.target)
         pkgbuildURL = self.AURURL + '/packages/' + self.target + '/PKGBUILD'
-        urllib.request.urlretrieve(pkgbuildURL, 'PKGBUILD')
-        os.chdir('../')
+        getClient().download(pkgbuildURL, self.workspace.join('PKGBUILD'),
+                             token=self.token)
+
+
+    def getSrcinfo(self):
+        """Downloads the .SRCINFO file, if the AUR has one.
+        """
+        srcinfoURL = self.AURURL + '/packages/' + self.target + '/.SRCINFO'
+        try:
+            getClient().download(srcinfoURL, self.workspace.join('.SRCINFO'),
+                                 token=self.token)
+        except Http.HttpError:
+            pass
+
+
+    def getMetadata(self):
+        """Reads the dependency related arrays of the package.
+        They come from .SRCINFO; the PKGBUILD is only sourced, by one of
+        the pooled bash workers, when there is no .SRCINFO.
+        """
+        srcinfo = self.workspace.join('.SRCINFO')
+        if os.path.exists(srcinfo):
+            with open(srcinfo, encoding='utf-8') as f:
+                self.srcinfo = f.read()
+            return Srcinfo.metadata(self.srcinfo, self.target)
+        return BashPool.getPool().evaluate(self.path)
 
 
     def getDepends(self):
         """Creates a list of the packages dependency.
         """
-        if not os.path.exists(self.target):
-            os.makedirs(self.target)
-        os.chdir(self.target)
-        retCode = subprocess.call(["chmod", "+x", "PKGBUILD"])
-        dependsString = subprocess.check_output(["../model/getDepends.sh"])
-        dependsString = dependsString.decode("utf-8")
-        depends = list(dependsString.split())
-        os.chdir('../')
-        return depends
+        return list(self.metadata['depends'])
 
 
     def getBuildDepends(self):
         """Creates a list of the packages build dependencies.
         """
-        if not os.path.exists(self.target):
-            os.makedirs(self.target)
-        os.chdir(self.target)
-        retCode = subprocess.call(["chmod", "+x", "PKGBUILD"])
-        dependsString = subprocess.check_output(["../model/getBuildDepends.sh"])
-        dependsString = dependsString.decode("utf-8")
-        buildDepends = list(dependsString.split())
-        os.chdir('../')
-        return buildDepends
+        return self.metadata['makedepends'] + self.metadata['checkdepends']
 
 
-    def makePkg(self):
+    def makePkg(self, syncDeps=True):
         """Creates package from PKGBUILD.
+        :param syncDeps: Let makepkg install missing dependencies.
+        Returns the exit status of makepkg, 0 if the packages came from
+        the package cache.
+        """
+        cache = None
+        if self.cacheable:
+            cache = PackageCache.getPackageCache()
+            if cache.fetch(self.buildKey, self.path) is not None:
+                self.cached = True
+                return 0
+        self.fetchSources()
+        args = ['makepkg', '--noconfirm']
+        if syncDeps:
+            args.append('-s')
+        if os.geteuid() == 0:
+            args = self.asBuildUser(args)
+        retCode = Cancel.call(args, self.token, cwd=self.path)
+        if retCode == 0 and cache is not None:
+            cache.store(self.buildKey, self.target, self.builtPackages())
+        return retCode
+
+
+    def asBuildUser(self, args):
+        """Returns args run as BUILDUSER through runuser, and hands the
+        workspace over to that user. Sources hard linked from the source
+        cache are left to root, makepkg only reads them.
+        With syncDeps, makepkg installs dependencies through sudo, so
+        BUILDUSER then needs to be allowed to run pacman with it.
+        Raises Pacman.PackageError if there is no unprivileged user.
         """
-        if not os.path.exists(self.target):
-            os.makedirs(self.target)
-        os.chdir(self.target)
+        if not BUILDUSER or BUILDUSER == 'root':
+            raise Pacman.PackageError('makepkg cannot run as root: start '
+                                      'potluck with sudo or set '
+                                      'POTLUCK_BUILDUSER')
         try:
-             retCode = subprocess.call('makepkg', '--asroot', '-s')
-             return retCode
-        except:
-             pass
-        os.chdir('../')
+            user = pwd.getpwnam(BUILDUSER)
+        except KeyError:
+            raise Pacman.PackageError('Unknown build user ' + BUILDUSER)
+        os.chown(self.path, user.pw_uid, user.pw_gid)
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and st.st_nlink == 1:
+                # VCS packages rewrite pkgver in their PKGBUILD
+                os.chown(path, user.pw_uid, user.pw_gid)
+        return ['runuser', '-u', BUILDUSER, '--'] + args
+
+
+    def fetchSources(self):
+        """Place the upstream sources in the workspace from the shared
+        source cache, downloading the ones it does not have yet.
+        Only sources listed with a checksum in .SRCINFO are handled, makepkg
+        downloads the rest itself.
+        Returns a list of Workers.Result, one per source.
+        """
+        if self.sourcesFetched or not USESRCCACHE or self.srcinfo is None:
+            return []
+        self.sourcesFetched = True
+        if self.cacheable and self.buildKey in PackageCache.getPackageCache():
+            # makePkg will not build, the sources are not needed
+            return []
+        sources = Srcinfo.sources(self.srcinfo)
+        return SourceCache.getSourceCache().prepare(self.path, sources,
+                                                    self.token)
+
+
+    def builtPackages(self):
+        """Returns the paths of the packages makepkg created.
+        """
+        return Pacman.builtPackages(self.path)
+
+
+    def cleanup(self):
+        """Remove the downloaded and built files.
+        """
+        self.workspace.cleanup()
 
 
 
-def outOfDate():
+def outOfDate(token=None, errors=None):
     """Checks AUR packages to see if they are out of date.
+    :param token: Cancel.CancelToken aborting pacman and the AUR requests.
+    :param errors: List failed AUR requests are added to, see
+                   getPkgInfoMany.
     """
     resultList = []
     updateList = []
     response = {}
     extensiveResponse = {}
-    output = subprocess.check_output(["pacman", "-Qm"])
+    output = Cancel.checkOutput(["pacman", "-Qm"], token)
     output = output.decode("utf-8")
     tempList = output.splitlines()
     for app in tempList:
         temp = app.split(' ')
         resultList.append(temp)
 
+    infos = getPkgInfoMany([app[0] for app in resultList], token, errors)
+    candidates = []
     for app in resultList:
-        response = getPkgInfo(app[0])
+        response = infos.get(app[0])
         if isinstance(response, dict):
             if response['OutOfDate'] != 0:
-                isNew = subprocess.check_output(["vercmp", response['Version'], app[1]])
-                isNew = isNew.decode("utf-8")
-                value = isNew.splitlines()
-                if int(value[0]) > 0:
-                    response['repo'] = 'aur'
-                    updateList.append(response)
+                candidates.append((response, app[1]))
+
+    newer = Vercmp.vercmpMany((r['Version'], v) for r, v in candidates)
+    for (response, version), value in zip(candidates, newer):
+        if value > 0:
+            response['repo'] = 'aur'
+            updateList.append(response)
     return updateList
 
 
 def getPkgInfo(target):
     """Gather info about the target package.
     :param target: Application for which to ather information about.
+    Returns None if the AUR does not know the package.
+    """
+    return getPkgInfoMany([target]).get(target)
+
+
+def multiinfoURLs(names):
+    """Build multiinfo query URLs covering all names.
+    :param names: Package names to query.
+    Each URL is kept below MAXURLLENGTH. Yields (url, names) tuples, with
+    the names the URL asks for.
+    """
+    baseURL = AURURL + '/rpc.php?type=multiinfo'
+    url = baseURL
+    chunk = []
+    for name in names:
+        arg = '&arg[]=' + urllib.parse.quote(name, safe='')
+        if chunk and len(url) + len(arg) > MAXURLLENGTH:
+            yield url, chunk
+            url = baseURL
+            chunk = []
+        url += arg
+        chunk.append(name)
+    if chunk:
+        yield url, chunk
+
+
+def getPkgInfoMany(targets, token=None, errors=None):
+    """Gather info about several packages with as few requests as possible.
+    :param targets: Names of the packages.
+    :param token: Cancel.CancelToken aborting the requests.
+    :param errors: List a Workers.Result is appended to for every failed
+                   request, holding the names it asked for and the error.
+                   Without it the first error is raised once all requests
+                   are done.
+    Returns a dictionary mapping each name known to the AUR to its info;
+    the names of failed requests are missing from it.
+    """
+    names = [n for n in dict.fromkeys(targets) if n]
+    result = {}
+    mirror = getMirror()
+    if mirror is not None:
+        result = mirror.getPkgInfoMany(names)
+        for app in result.values():
+            app['repo'] = 'aur'
+        return result
+    fetched = Workers.runAll(
+        lambda chunk: decodeRpc(rpc(chunk[0], 'multiinfo', token)),
+        multiinfoURLs(names), WORKERS)
+    failed = []
+    for r in fetched:
+        if not r.ok():
+            failed.append(Workers.Result(r.item[1], error=r.error))
+            continue
+        response = r.value['results']
+        if not isinstance(response, list):
+            continue
+        for app in response:
+            app['repo'] = 'aur'
+            result[app['Name']] = app
+    for f in failed:
+        if isinstance(f.error, Cancel.CancelledError):
+            raise f.error
+    if errors is not None:
+        errors += failed
+    elif failed:
+        raise failed[0].error
+    return result
+
+
+def getUpgrades(targets, token=None):
+    """Download PKGBUILDs and read the dependencies of several packages in
+    parallel.
+    :param targets: Names of the packages.
+    :param token: Cancel.CancelToken aborting the downloads.
+    Returns a list of Workers.Result holding an Upgrade for every target,
+    in the same order. A failed download is reported in its Result.
     """
-    AURSearchURL = AURURL + '/rpc.php?type=info&arg='
-    info = []
-    infoURL = AURSearchURL + target
-
-    value = urllib.request.urlopen(infoURL).read()
-    info = json.loads(value.decode("utf-8"))
-    response = info['results']
-    response['repo'] = 'aur'
-    return response
+    return Workers.runAll(lambda target: Upgrade(target, token=token),
+                          targets, WORKERS)
 
 
 
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# A local index of the AUR built from its bulk metadata dump
+# (packages-meta-v1.json.gz), so searches and info lookups can be answered
+# without the network.
+
+import os
+import sys
+import time
+import gzip
+import json
+import codecs
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import urllib.request
+
+from .Cache import CACHEDIR
+
+DUMPNAME = 'packages-meta-v1.json.gz'
+MIRRORPATH = os.path.join(CACHEDIR, 'aur-mirror.sqlite')
+
+# Characters read from the dump at a time
+CHUNKSIZE = 256 * 1024
+
+# Seconds after the last refresh in which the mirror is trusted; older
+# mirrors are ignored so that lookups go to the RPC instead
+MAXAGE = 24 * 60 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS packages (
+    name TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    description TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+class MirrorError(Exception):
+    """Exception that is raised when the mirror cannot be built.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+
+
+def iterArray(stream, chunkSize=CHUNKSIZE):
+    """Decode the elements of a JSON array one at a time.
+    :param stream: Binary file object holding UTF-8 JSON.
+    :param chunkSize: Bytes read at a time.
+    Only the element being decoded is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    reader = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        # Skip whitespace, the opening bracket and separating commas
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ',' or
+                                      (buf[pos] == '[' and not started)):
+                if buf[pos] == '[':
+                    started = True
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            chunk = stream.read(chunkSize)
+            eof = not chunk
+            buf = reader.decode(chunk, final=eof)
+            pos = 0
+        if pos >= len(buf) or buf[pos] == ']':
+            return
+        if not started:
+            raise MirrorError('Metadata dump is not a JSON array')
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise MirrorError('Truncated metadata dump')
+            chunk = stream.read(chunkSize)
+            eof = not chunk
+            buf = buf[pos:] + reader.decode(chunk, final=eof)
+            pos = 0
+            continue
+        yield obj
+        pos = end
+
+
+def digest(record):
+    """Returns a stable hash of a package record.
+    """
+    data = json.dumps(record, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def likePattern(term):
+    """Escape a search term for a LIKE '%term%' match.
+    """
+    term = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + term + '%'
+
+
+class Mirror:
+    """Offline copy of the AUR package metadata.
+    """
+
+
+    def __init__(self, path=MIRRORPATH):
+        """Initialize a mirror.
+        :param path: sqlite database holding the index.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+
+    def connect(self):
+        """Open a read-only connection to the index, one per call so the
+        mirror can be used from any thread.
+        """
+        uri = 'file:' + urllib.request.pathname2url(os.path.abspath(self.path))
+        return sqlite3.connect(uri + '?mode=ro', uri=True)
+
+
+    def connectWritable(self):
+        """Open a connection for updating the index, creating it if needed.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.executescript(SCHEMA)
+        return conn
+
+
+    def age(self):
+        """Returns the seconds since the index was last refreshed, or None
+        if it never was.
+        """
+        ingested = self.getMeta('ingested')
+        if ingested is None:
+            return None
+        return time.time() - float(ingested)
+
+
+    def available(self, maxAge=MAXAGE):
+        """Returns True if the mirror has been populated and refreshed
+        within maxAge seconds.
+        """
+        if not os.path.exists(self.path):
+            return False
+        try:
+            age = self.age()
+            if age is None or age > maxAge:
+                return False
+            conn = self.connect()
+            try:
+                row = conn.execute('SELECT 1 FROM packages LIMIT 1').fetchone()
+            finally:
+                conn.close()
+        except (sqlite3.Error, ValueError):
+            return False
+        return row is not None
+
+
+    def ingest(self, stream):
+        """Update the index from an uncompressed dump.
+        :param stream: Binary file object holding the JSON array.
+        Only entries that differ from the previous dump are written.
+        Returns a dictionary with the number of added, changed, removed and
+        unchanged entries.
+        """
+        counts = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+        with self.lock:
+            conn = self.connectWritable()
+            try:
+                known = dict(conn.execute('SELECT name, digest FROM packages'))
+                seen = set()
+                with conn:
+                    for record in iterArray(stream):
+                        name = record.get('Name')
+                        if not name or name in seen:
+                            continue
+                        seen.add(name)
+                        d = digest(record)
+                        old = known.get(name)
+                        if old == d:
+                            counts['unchanged'] += 1
+                            continue
+                        conn.execute('INSERT OR REPLACE INTO packages '
+                                     '(name, digest, description, data) '
+                                     'VALUES (?, ?, ?, ?)',
+                                     (name, d, record.get('Description') or '',
+                                      json.dumps(record)))
+                        if old is None:
+                            counts['added'] += 1
+                        else:
+                            counts['changed'] += 1
+                    for name in known:
+                        if name not in seen:
+                            conn.execute('DELETE FROM packages WHERE name = ?',
+                                         (name,))
+                            counts['removed'] += 1
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) "
+                                 "VALUES ('ingested', ?)", (str(time.time()),))
+            finally:
+                conn.close()
+        return counts
+
+
+    def refresh(self, source, client=None):
+        """Update the index from a gzipped dump.
+        :param source: Path or http(s) URL of packages-meta-v1.json.gz.
+        :param client: Http.Client used for URLs.
+        Returns the counts of ingest, or None if the server reported that
+        the dump did not change since the last refresh.
+        """
+        if not source.startswith(('http://', 'https://')):
+            with gzip.open(source, 'rb') as stream:
+                return self.ingest(stream)
+
+        headers = {}
+        lastModified = self.getMeta('lastModified')
+        if lastModified:
+            headers['If-Modified-Since'] = lastModified
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.dump-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                response = client.request(source, headers, sink=f)
+            if response.status == 304:
+                # Still current, trust it for another MAXAGE
+                self.setMeta('ingested', str(time.time()))
+                return None
+            if response.status >= 400:
+                raise MirrorError('%s returned %d' % (source, response.status))
+            with gzip.open(tmp, 'rb') as stream:
+                counts = self.ingest(stream)
+            self.setMeta('lastModified', response.headers.get('Last-Modified'))
+            return counts
+        finally:
+            os.unlink(tmp)
+
+
+    def getMeta(self, key):
+        """Returns a value stored alongside the index, None if there is no
+        index yet.
+        """
+        try:
+            conn = self.connect()
+            try:
+                row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                                   (key,)).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+
+    def setMeta(self, key, value):
+        """Store a value alongside the index.
+        """
+        conn = self.connectWritable()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO meta (key, value) '
+                             'VALUES (?, ?)', (key, value))
+        finally:
+            conn.close()
+
+
+    def search(self, term):
+        """Search names and descriptions like the AUR RPC search does.
+        :param term: Substring to look for, case insensitive.
+        """
+        pattern = likePattern(term)
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT data FROM packages WHERE "
+                                "name LIKE ? ESCAPE '\\' OR "
+                                "description LIKE ? ESCAPE '\\' "
+                                "ORDER BY name", (pattern, pattern)).fetchall()
+        finally:
+            conn.close()
+        return [json.loads(row[0]) for row in rows]
+
+
+    def getPkgInfoMany(self, names):
+        """Returns a dictionary mapping each known name to its record.
+        :param names: Names of packages.
+        """
+        names = list(dict.fromkeys(names))
+        result = {}
+        conn = self.connect()
+        try:
+            # Stay below sqlite's limit on bound parameters
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
+                marks = ','.join('?' * len(chunk))
+                for row in conn.execute('SELECT name, data FROM packages '
+                                        'WHERE name IN (%s)' % marks, chunk):
+                    result[row[0]] = json.loads(row[1])
+        finally:
+            conn.close()
+        return result
+
+
+
+
+_mirror = None
+_mirrorLock = threading.Lock()
+
+def getMirror():
+    """Returns the shared Mirror instance.
+    """
+    global _mirror
+    with _mirrorLock:
+        if _mirror is None:
+            _mirror = Mirror()
+        return _mirror
+
+
+
+
+# Build or refresh the mirror:
+#   python3 -m model.AurMirror [path or URL of packages-meta-v1.json.gz]
+if (__name__ == "__main__"):
+
+    from . import Aur
+
+    if (len(sys.argv) > 1):
+        source = sys.argv[1]
+    else:
+        source = Aur.AURURL + '/' + DUMPNAME
+
+    counts = getMirror().refresh(source, Aur.getClient())
+    if counts is None:
+        print('Mirror is up to date')
+    else:
+        print('%(added)d added, %(changed)d changed, %(removed)d removed, '
+              '%(unchanged)d unchanged' % counts)
+
+
+
+
+# vim: set ts=4 sw=4 noet:
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# A pool of long-lived bash processes that source PKGBUILDs, for packages
+# that come without a .SRCINFO.
+
+import os
+import time
+import queue
+import select
+import signal
+import threading
+import subprocess
+
+from . import Workers
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'pkgbuildWorker.sh')
+
+# Number of bash processes
+SIZE = min(4, os.cpu_count() or 1)
+
+# Evaluations after which a bash process is replaced
+MAXEVALUATIONS = 100
+
+# Seconds a PKGBUILD may take to source
+TIMEOUT = 30
+
+ENDOFRECORD = b'\x01'
+
+
+class EvalError(Exception):
+    """Exception that is raised when a PKGBUILD cannot be evaluated.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class SourceError(EvalError):
+    """Exception that is raised when sourcing a PKGBUILD fails. The worker
+    that reported it is still usable.
+    """
+
+
+
+
+def parseRecord(tokens):
+    """Turn the tokens of one worker record into a metadata dictionary.
+    :param tokens: NUL separated strings of the record, without the end
+                   of record marker.
+    """
+    if not tokens or tokens[0] != '0':
+        raise SourceError('sourcing the PKGBUILD failed')
+    result = {}
+    i = 1
+    while i + 1 < len(tokens):
+        field = tokens[i]
+        count = int(tokens[i + 1])
+        result[field] = [v for v in tokens[i + 2:i + 2 + count] if v]
+        i += 2 + count
+    return result
+
+
+class Worker:
+    """One bash process evaluating PKGBUILDs one after another.
+    """
+
+
+    def __init__(self):
+        """Start a bash worker.
+        """
+        self.proc = subprocess.Popen([SCRIPT], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL,
+                                     start_new_session=True)
+        self.evaluations = 0
+        self.buffer = b''
+
+
+    def alive(self):
+        return self.proc.poll() is None
+
+
+    def readRecord(self, timeout):
+        """Read tokens up to the next end of record marker.
+        """
+        deadline = time.monotonic() + timeout
+        fd = self.proc.stdout.fileno()
+        tokens = []
+        while True:
+            while b'\0' in self.buffer:
+                token, sep, self.buffer = self.buffer.partition(b'\0')
+                if token == ENDOFRECORD:
+                    return tokens
+                tokens.append(token.decode('utf-8', 'replace'))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise EvalError('timed out')
+            ready, w, x = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                raise EvalError('bash worker exited')
+            self.buffer += data
+
+
+    def evaluate(self, directory, timeout=TIMEOUT):
+        """Source the PKGBUILD in directory and return its metadata.
+        """
+        self.evaluations += 1
+        try:
+            self.proc.stdin.write(os.fsencode(os.path.abspath(directory)) + b'\0')
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            raise EvalError('bash worker exited')
+        return parseRecord(self.readRecord(timeout))
+
+
+    def close(self, force=False):
+        """Stop the worker.
+        :param force: Kill it along with a PKGBUILD that may still be
+                      running instead of letting it finish.
+        """
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        if not force:
+            try:
+                self.proc.wait(1)
+            except subprocess.TimeoutExpired:
+                force = True
+        if force:
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.proc.wait()
+        self.proc.stdout.close()
+
+
+
+
+class BashPool:
+    """A fixed number of bash workers, recycled after maxEvaluations.
+    """
+
+
+    def __init__(self, size=SIZE, maxEvaluations=MAXEVALUATIONS, timeout=TIMEOUT):
+        """Initialize a pool. Workers are started on first use.
+        :param size: Number of bash processes.
+        :param maxEvaluations: PKGBUILDs a process sources before it is
+                               replaced by a fresh one.
+        :param timeout: Seconds a single PKGBUILD may take.
+        """
+        self.size = size
+        self.maxEvaluations = maxEvaluations
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return Worker()
+
+
+    def release(self, worker, healthy):
+        if healthy and worker.alive() and \
+           worker.evaluations < self.maxEvaluations:
+            self.idle.put(worker)
+        else:
+            worker.close(force=not healthy)
+        self.slots.release()
+
+
+    def evaluate(self, directory):
+        """Returns the metadata of the PKGBUILD in directory.
+        :param directory: Directory holding the PKGBUILD.
+        """
+        worker = self.acquire()
+        healthy = False
+        try:
+            result = worker.evaluate(directory, self.timeout)
+            healthy = True
+            return result
+        except SourceError:
+            healthy = True
+            raise
+        finally:
+            self.release(worker, healthy)
+
+
+    def evaluateMany(self, directories):
+        """Evaluate several PKGBUILDs using all workers.
+        Returns a list of Workers.Result in the order of directories.
+        """
+        return Workers.runAll(self.evaluate, directories, self.size)
+
+
+    def close(self):
+        """Stop all idle workers.
+        """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+
+
+_pool = None
+_poolLock = threading.Lock()
+
+def getPool():
+    """Returns the shared BashPool instance.
+    """
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = BashPool()
+        return _pool
+
+
+
+
+# vim: set ts=4 sw=4 noet:
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# Builds the AUR packages of a resolved plan: sources are fetched while
+# independent makepkg processes run side by side, and packages are
+# installed in batches, each before anything that depends on it is started.
+
+import os
+import time
+import threading
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import Pacman
+from . import Progress
+from . import Cancel
+
+MEMINFO = '/proc/meminfo'
+
+# Memory a single makepkg run is assumed to need
+MEMPERBUILD = 1536 * 1024 * 1024
+
+# Maximum number of packages whose sources are fetched at the same time
+FETCHWORKERS = 4
+
+# Build states reported by Scheduler.run
+BUILT = 'built'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class BuildError(Exception):
+    """Exception that is raised when a package cannot be built.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+
+
+def memAvailable(path=MEMINFO):
+    """Returns the memory available for new processes in bytes, or None
+    if the kernel does not say.
+    """
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def buildSlots(memPerBuild=MEMPERBUILD):
+    """Returns how many makepkg processes may run at the same time.
+    Limited by the number of CPUs and by the available memory.
+    :param memPerBuild: Memory reserved for each build in bytes.
+    """
+    slots = os.cpu_count() or 1
+    available = memAvailable()
+    if available is not None:
+        slots = min(slots, available // memPerBuild)
+    return max(1, slots)
+
+
+class Timings:
+    """Time spent per stage of an install.
+    Keeps, for each stage, how often it ran, the time the runs took added
+    up (busy) and the time from the first start to the last end (wall).
+    Stages running side by side show a wall time below their busy time.
+    """
+
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        """Context manager timing one run of stage.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            with self.lock:
+                s = self.stages.setdefault(stage, {'count': 0, 'busy': 0.0,
+                                                   'start': start, 'end': end})
+                s['count'] += 1
+                s['busy'] += end - start
+                s['start'] = min(s['start'], start)
+                s['end'] = max(s['end'], end)
+
+
+    def report(self):
+        """Returns the timings as a printable table.
+        """
+        lines = ['%-10s %5s %9s %9s' % ('stage', 'runs', 'wall', 'busy')]
+        with self.lock:
+            for stage, s in self.stages.items():
+                lines.append('%-10s %5d %8.2fs %8.2fs' % (stage, s['count'],
+                             s['end'] - s['start'], s['busy']))
+        return '\n'.join(lines)
+
+
+
+
+class Scheduler:
+    """Runs the builds of a Resolver.Plan as a pipeline.
+    The sources of every package are fetched up front, in parallel. A
+    package is built as soon as its sources are there and the AUR packages
+    it needs are installed, so downloads, builds of independent packages
+    and installs overlap. Built packages are installed together whenever a
+    waiting build needs them and once at the end: one pacman -U --asdeps
+    for the dependencies the plan pulled in, one pacman -U for targets.
+    """
+
+
+    def __init__(self, plan, slots=None, timings=None, progress=None,
+                 token=None):
+        """Initialize a scheduler.
+        :param plan: Resolver.Plan to build.
+        :param slots: Maximum number of concurrent builds, from buildSlots
+                      if None.
+        :param timings: Timings to record the stages in, a new one if None.
+        :param progress: Called with a Progress.Event whenever a build
+                         starts and for the output of pacman -U.
+        :param token: Cancel.CancelToken; once cancelled nothing new is
+                      started and the running builds are interrupted.
+        """
+        self.plan = plan
+        if slots is None:
+            slots = buildSlots()
+        self.slots = max(1, slots)
+        if timings is None:
+            timings = Timings()
+        self.timings = timings
+        # name -> build state
+        self.states = {}
+        # name -> reason the package was not built
+        self.errors = {}
+        # Number of pacman -U transactions run
+        self.installs = 0
+        # Number of packages built and installed, read by builder threads
+        # while states changes, so kept apart under progressLock
+        self.done = 0
+        self.progress = progress
+        self.progressLock = threading.Lock()
+        self.token = token
+
+
+    def report(self, phase, name, message):
+        """Pass a Progress.Event to the progress callback.
+        """
+        if self.progress is None:
+            return
+        with self.progressLock:
+            self.progress(Progress.Event(phase, name, self.done,
+                                         len(self.plan.order), message=message))
+
+
+    def fetch(self, name):
+        """Fetch the sources of one package. Runs on a worker thread.
+        """
+        with self.timings.measure('fetch'):
+            self.plan.upgrades[name].fetchSources()
+
+
+    def build(self, name):
+        """Build one package. Runs on a worker thread; the build itself is
+        a separate makepkg process.
+        :param name: Name of an AUR package in the plan.
+        Returns the paths of the built package files.
+        """
+        self.report(Progress.BUILD, name, 'Building ' + name)
+        with self.timings.measure('build'):
+            upgrade = self.plan.upgrades[name]
+            # Dependencies are installed before, so makepkg does not need
+            # to call pacman (which would fight over its lock with installs)
+            if upgrade.makePkg(syncDeps=False) != 0:
+                raise BuildError('makepkg failed for ' + name)
+            files = upgrade.builtPackages()
+            if not files:
+                raise BuildError('makepkg produced no package for ' + name)
+            return files
+
+
+    def install(self, built):
+        """Install built packages, the dependencies the plan pulled in
+        first and marked as such, then the targets, one pacman transaction
+        each.
+        :param built: Dictionary mapping package names to their files.
+        Returns the set of packages that were installed.
+        """
+        targets = set(self.plan.targets)
+        groups = [(dict((n, f) for n, f in built.items() if n not in targets),
+                   True),
+                  (dict((n, f) for n, f in built.items() if n in targets),
+                   False)]
+        installed = set()
+        for group, asDeps in groups:
+            if not group:
+                continue
+            files = []
+            for name in self.plan.order:
+                files += group.get(name, [])
+            try:
+                with self.timings.measure('install'):
+                    self.installs += 1
+                    Pacman.installFiles(files, asDeps,
+                                        self.installProgress(group),
+                                        self.token)
+            except (Pacman.PackageError, Cancel.CancelledError) as e:
+                for name in built:
+                    if name not in installed:
+                        self.states[name] = FAILED
+                        self.errors[name] = e
+                break
+            for name in group:
+                self.states[name] = BUILT
+            installed |= set(group)
+            with self.progressLock:
+                self.done += len(group)
+        return installed
+
+
+    def installProgress(self, built):
+        """Returns the progress callback for a pacman -U of built, which
+        counts its packages as part of the whole plan.
+        """
+        if self.progress is None:
+            return None
+        with self.progressLock:
+            done = self.done
+
+        def relay(event):
+            if event.total:
+                event.current = done + min(event.current, len(built))
+            else:
+                event.current = done
+            event.total = len(self.plan.order)
+            with self.progressLock:
+                self.progress(event)
+        return relay
+
+
+    def run(self):
+        """Fetch, build and install every package of the plan.
+        A failed build does not stop unrelated ones; packages depending on
+        it are skipped. After a cancel, packages not built yet are skipped.
+        Returns a dictionary mapping each package to BUILT, FAILED or SKIPPED.
+        """
+        # name -> AUR dependencies not installed yet
+        waiting = dict((n, set(self.plan.edges[n])) for n in self.plan.order)
+        dependents = dict((n, []) for n in self.plan.order)
+        for name in self.plan.order:
+            for dep in self.plan.edges[name]:
+                dependents[dep].append(name)
+        fetched = set()
+        started = set()
+        # name -> package files, built but not installed yet
+        built = {}
+
+        def skip(name, reason):
+            for d in dependents[name]:
+                if d not in self.states:
+                    self.states[d] = SKIPPED
+                    self.errors[d] = reason
+                    skip(d, reason)
+
+        def installBuilt():
+            installed = self.install(built)
+            for name in list(built):
+                if name in installed:
+                    for d in dependents[name]:
+                        waiting[d].discard(name)
+                else:
+                    skip(name, BuildError(name + ' failed to install'))
+            built.clear()
+
+        def blocked():
+            # Is a package only waiting for packages that are already built?
+            for name in self.plan.order:
+                if name not in started and name not in self.states and \
+                   waiting[name] and waiting[name] <= set(built):
+                    return True
+            return False
+
+        with ThreadPoolExecutor(max_workers=FETCHWORKERS) as fetchers, \
+             ThreadPoolExecutor(max_workers=self.slots) as builders:
+            running = {}
+            for name in self.plan.order:
+                running[fetchers.submit(self.fetch, name)] = ('fetch', name)
+
+            while running:
+                done, pending = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, name = running.pop(future)
+                    error = future.exception()
+                    if stage == 'fetch':
+                        # makepkg downloads whatever could not be fetched
+                        fetched.add(name)
+                    elif error is None:
+                        built[name] = future.result()
+                    else:
+                        self.states[name] = FAILED
+                        self.errors[name] = error
+                        skip(name, BuildError(name + ' failed to build'))
+                if Cancel.cancelled(self.token):
+                    continue
+                if built and blocked():
+                    installBuilt()
+                for name in self.plan.order:
+                    if name in fetched and name not in started and \
+                       name not in self.states and not waiting[name]:
+                        started.add(name)
+                        running[builders.submit(self.build, name)] = ('build', name)
+            if built and not Cancel.cancelled(self.token):
+                installBuilt()
+        if Cancel.cancelled(self.token):
+            for name in self.plan.order:
+                if name not in self.states:
+                    self.states[name] = SKIPPED
+                    self.errors[name] = Cancel.CancelledError()
+        return dict(self.states)
+
+
+
+
+# vim: set ts=4 sw=4 noet:
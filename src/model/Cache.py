@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# Persistent cache of AUR RPC responses under ~/.cache/potluck.
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import http.client
+
+from . import Http
+
+CACHEDIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.join(os.path.expanduser('~'), '.cache'),
+                        'potluck')
+
+# Seconds a response stays fresh, per RPC endpoint
+TTLS = {
+    'search': 10 * 60,
+    'info': 60 * 60,
+    'multiinfo': 60 * 60,
+}
+DEFAULTTTL = 10 * 60
+
+# Upper bound of the cache size in bytes
+MAXSIZE = 32 * 1024 * 1024
+
+# Errors after which a stale entry is served rather than nothing at all
+NETWORKERRORS = (OSError, Http.HttpError, http.client.HTTPException)
+
+
+def isRpcError(body):
+    """Returns True if body is an RPC reply reporting an error, such as a
+    rate limit or too many search results, which must not be cached.
+    """
+    try:
+        value = json.loads(body.decode('utf-8'))
+    except ValueError:
+        return False
+    return isinstance(value, dict) and value.get('type') == 'error'
+
+
+def writeAtomic(path, data):
+    """Write a file so that readers see either the old or the new contents.
+    :param path: File to write.
+    :param data: Bytes to write.
+    """
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class Entry:
+    """A cached response.
+    """
+
+
+    def __init__(self, url, endpoint, stored, etag, lastModified, body):
+        self.url = url
+        self.endpoint = endpoint
+        self.stored = stored
+        self.etag = etag
+        self.lastModified = lastModified
+        self.body = body
+
+
+    def fresh(self, ttl, now=None):
+        """Returns True if the entry is younger than ttl seconds.
+        """
+        if now is None:
+            now = time.time()
+        return now - self.stored < ttl
+
+
+    def serialize(self):
+        """Returns the on-disk form: a JSON header line followed by the body.
+        """
+        header = {}
+        header['url'] = self.url
+        header['endpoint'] = self.endpoint
+        header['stored'] = self.stored
+        header['etag'] = self.etag
+        header['lastModified'] = self.lastModified
+        return json.dumps(header).encode('utf-8') + b'\n' + self.body
+
+
+    @staticmethod
+    def parse(data):
+        """Rebuild an entry from its on-disk form.
+        """
+        header, sep, body = data.partition(b'\n')
+        h = json.loads(header.decode('utf-8'))
+        return Entry(h['url'], h['endpoint'], h['stored'], h.get('etag'),
+                     h.get('lastModified'), body)
+
+
+
+
+class ResponseCache:
+    """Size-bounded, least recently used, on-disk cache of HTTP responses.
+    """
+
+
+    def __init__(self, path=None, maxSize=MAXSIZE, ttls=None):
+        """Initialize a response cache.
+        :param path: Directory of the cache, CACHEDIR/rpc if None.
+        :param maxSize: Size in bytes above which old entries are evicted.
+        :param ttls: Freshness per endpoint, TTLS if None.
+        """
+        if path is None:
+            path = os.path.join(CACHEDIR, 'rpc')
+        self.path = path
+        self.maxSize = maxSize
+        self.ttls = TTLS if ttls is None else ttls
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+
+    def filename(self, url):
+        """Returns the file an URL is cached in.
+        """
+        return os.path.join(self.path,
+                            hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+
+    def load(self, url):
+        """Returns the cached entry for url or None.
+        """
+        try:
+            with open(self.filename(url), 'rb') as f:
+                entry = Entry.parse(f.read())
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        if entry.url != url:
+            return None
+        return entry
+
+
+    def touch(self, url):
+        """Mark an entry as recently used.
+        """
+        try:
+            os.utime(self.filename(url))
+        except OSError:
+            pass
+
+
+    def store(self, entry):
+        """Write an entry to disk and evict old entries if needed.
+        The cache is best effort, failures to write are ignored.
+        """
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            writeAtomic(self.filename(entry.url), entry.serialize())
+            self.evict()
+        except (IOError, OSError):
+            pass
+
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits maxSize.
+        """
+        with self.lock:
+            files = []
+            total = 0
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            if total <= self.maxSize:
+                return
+            files.sort()
+            for mtime, size, path in files:
+                if total <= self.maxSize:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+    def get(self, url, endpoint, client, token=None):
+        """Returns the body of url, from the cache when it is fresh.
+        :param url: URL to request.
+        :param endpoint: RPC endpoint, selects the TTL.
+        :param client: Http.Client used on a miss.
+        :param token: Cancel.CancelToken aborting the request.
+        Stale entries are revalidated with If-None-Match/If-Modified-Since
+        and served as they are if the server cannot be reached or answers
+        with an RPC error. RPC errors are never stored.
+        """
+        ttl = self.ttls.get(endpoint, DEFAULTTTL)
+        entry = self.load(url)
+        if entry is not None and entry.fresh(ttl):
+            self.touch(url)
+            self.hits += 1
+            return entry.body
+
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.lastModified:
+                headers['If-Modified-Since'] = entry.lastModified
+        try:
+            response = client.request(url, headers, token=token)
+        except NETWORKERRORS:
+            if entry is not None:
+                return entry.body
+            raise
+
+        if response.status == 304 and entry is not None:
+            self.revalidated += 1
+            entry.stored = time.time()
+            self.store(entry)
+            return entry.body
+        if response.status >= 400:
+            if entry is not None and response.status >= 500:
+                return entry.body
+            raise Http.HttpError('%s returned %d' % (url, response.status),
+                                 response.status)
+
+        self.misses += 1
+        if isRpcError(response.body):
+            # Passed on for the caller to report, never kept
+            if entry is not None:
+                return entry.body
+            return response.body
+        self.store(Entry(url, endpoint, time.time(),
+                         response.headers.get('ETag'),
+                         response.headers.get('Last-Modified'),
+                         response.body))
+        return response.body
+
+
+    def clear(self):
+        """Remove every entry.
+        """
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+
+
+_cache = None
+_cacheLock = threading.Lock()
+
+def getCache():
+    """Returns the shared ResponseCache instance.
+    """
+    global _cache
+    with _cacheLock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
+
+
+
+
+# vim: set ts=4 sw=4 noet:
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# Cooperative cancellation. A CancelToken is handed down to everything a
+# transaction runs; cancelling it interrupts the subprocesses and HTTP
+# requests that are in progress, which then raise CancelledError in the
+# thread that waits for them.
+
+import os
+import signal
+import threading
+import contextlib
+import subprocess
+
+# Seconds a cancelled process group gets to exit after SIGINT before it
+# is killed. Enough for read-only commands; processes that write state
+# pass a longer delay to process.
+KILLDELAY = 0.1
+
+# Seconds between two checks of a token while waiting for a lock
+POLLINTERVAL = 0.05
+
+
+class CancelledError(Exception):
+    """Exception that is raised when an operation was cancelled.
+    """
+    def __init__(self, value='Cancelled'):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+
+
+class CancelToken:
+    """Tells running operations to stop.
+    Operations that block register a callback, which cancel calls from
+    the cancelling thread to wake them up.
+    """
+
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = {}
+        self.nextHandle = 0
+
+
+    def cancel(self):
+        """Cancel every operation using the token. Returns immediately;
+        the operations raise CancelledError in their own threads.
+        """
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            callbacks = list(self.callbacks.values())
+        for func in callbacks:
+            try:
+                func()
+            except Exception:
+                pass
+
+
+    def cancelled(self):
+        """Returns True once cancel was called.
+        """
+        return self.event.is_set()
+
+
+    def check(self):
+        """Raise CancelledError if the token was cancelled.
+        """
+        if self.event.is_set():
+            raise CancelledError()
+
+
+    def register(self, func):
+        """Have cancel call func. It is called right away if the token is
+        cancelled already.
+        Returns a handle for unregister.
+        """
+        with self.lock:
+            if not self.event.is_set():
+                handle = self.nextHandle
+                self.nextHandle += 1
+                self.callbacks[handle] = func
+                return handle
+        func()
+        return None
+
+
+    def unregister(self, handle):
+        """Forget a callback added with register.
+        """
+        with self.lock:
+            self.callbacks.pop(handle, None)
+
+
+
+
+def cancelled(token):
+    """Returns True if token is cancelled; None is never cancelled.
+    """
+    return token is not None and token.cancelled()
+
+
+def check(token):
+    """Raise CancelledError if token is cancelled; None is never cancelled.
+    """
+    if token is not None:
+        token.check()
+
+
+@contextlib.contextmanager
+def onCancel(token, func):
+    """Context manager having token call func if it is cancelled while the
+    block runs. Does nothing if token is None.
+    """
+    if token is None:
+        yield
+        return
+    handle = token.register(func)
+    try:
+        yield
+    finally:
+        token.unregister(handle)
+
+
+def signalGroup(proc, signum):
+    """Send a signal to the process group of proc. Children left behind
+    are in the group even after proc itself exited.
+    """
+    try:
+        os.killpg(proc.pid, signum)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def interrupt(proc, killDelay=KILLDELAY):
+    """Send the process group of proc SIGINT, and SIGKILL killDelay
+    seconds later.
+    Returns the threading.Timer sending SIGKILL; cancel it once proc
+    exited, as its process group id may be reused.
+    """
+    signalGroup(proc, signal.SIGINT)
+    killer = threading.Timer(killDelay, signalGroup, (proc, signal.SIGKILL))
+    killer.daemon = True
+    killer.start()
+    return killer
+
+
+@contextlib.contextmanager
+def process(args, token=None, killDelay=KILLDELAY, onKill=None, **kwargs):
+    """Context manager running a subprocess.Popen(args, **kwargs).
+    With a token the process gets a process group of its own. Cancelling
+    the token sends the group SIGINT, so pacman and makepkg can remove
+    their lock files, and SIGKILL if it has not exited killDelay seconds
+    later. The process has been waited for when the block is left, and
+    CancelledError is raised if the token was cancelled.
+    :param onKill: Called once the process was waited for if it had to
+                   be killed, e.g. to remove a lock file it left behind.
+    """
+    if token is None:
+        with subprocess.Popen(args, **kwargs) as proc:
+            yield proc
+        return
+    token.check()
+    proc = subprocess.Popen(args, start_new_session=True, **kwargs)
+    killers = []
+    handle = token.register(lambda: killers.append(interrupt(proc, killDelay)))
+    try:
+        yield proc
+    finally:
+        for pipe in (proc.stdin, proc.stdout, proc.stderr):
+            if pipe is not None:
+                pipe.close()
+        proc.wait()
+        token.unregister(handle)
+        for killer in killers:
+            killer.cancel()
+        if token.cancelled() and proc.returncode == -signal.SIGKILL and \
+           onKill is not None:
+            onKill()
+        token.check()
+
+
+def call(args, token=None, killDelay=KILLDELAY, onKill=None, **kwargs):
+    """Like subprocess.call, cancelled with token, see process.
+    Returns the exit status.
+    """
+    with process(args, token, killDelay, onKill, **kwargs) as proc:
+        pass
+    return proc.returncode
+
+
+def checkOutput(args, token=None, **kwargs):
+    """Like subprocess.check_output, cancelled with token.
+    Returns the output as bytes.
+    """
+    with process(args, token, stdout=subprocess.PIPE, **kwargs) as proc:
+        output = proc.stdout.read()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, output)
+    return output
+
+
+
+
+# vim: set ts=4 sw=4 noet:
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# A small HTTP/1.1 client that keeps connections alive between requests.
+
+import os
+import gzip
+import errno
+import select
+import socket
+import tempfile
+import http.client
+import threading
+import time
+import urllib.parse
+import zlib
+
+from . import Cancel
+
+# Errors meaning a kept-alive connection was closed by the server
+STALEERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+               ConnectionResetError, BrokenPipeError)
+
+REDIRECTS = (301, 302, 303, 307, 308)
+
+# Bytes read at a time when streaming a response to a file
+CHUNKSIZE = 64 * 1024
+
+
+class HttpError(Exception):
+    """Exception that is raised when a request fails.
+    """
+    def __init__(self, value, status=None):
+        self.value = value
+        self.status = status
+
+    def __str__(self):
+        return repr(self.value)
+
+
+
+
+def abortSockets(sockets):
+    """Make a request blocked on one of sockets fail right away. Called
+    from another thread when the request is cancelled.
+    """
+    for sock in list(sockets):
+        if sock is None:
+            continue
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def connectSocket(address, timeout, sourceAddress=None, token=None,
+                  duplicates=None):
+    """Like socket.create_connection, but cancelled with token. The
+    connect is polled so a cancel does not wait for the TCP timeout; the
+    name lookup cannot be interrupted, the token is checked after it.
+    :param address: (host, port) to connect to.
+    :param timeout: Timeout of the connect and of the socket in seconds.
+    :param sourceAddress: (host, port) to bind to, or None.
+    :param token: Cancel.CancelToken aborting the connect.
+    :param duplicates: List a duplicate of the connected socket is added
+                       to. Shutting it down aborts the socket even after
+                       ssl took it over; the caller closes it.
+    """
+    host, port = address
+    error = None
+    for family, kind, proto, name, addr in socket.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM):
+        Cancel.check(token)
+        sock = socket.socket(family, kind, proto)
+        try:
+            if sourceAddress:
+                sock.bind(sourceAddress)
+            sock.setblocking(False)
+            deadline = time.monotonic() + timeout
+            status = sock.connect_ex(addr)
+            while status in (errno.EINPROGRESS, errno.EALREADY,
+                             errno.EWOULDBLOCK):
+                Cancel.check(token)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout('timed out')
+                r, writable, x = select.select(
+                    [], [sock], [], min(remaining, Cancel.POLLINTERVAL))
+                if writable:
+                    status = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if status != 0:
+                raise OSError(status, os.strerror(status))
+            sock.settimeout(timeout)
+            if duplicates is not None:
+                duplicates.append(sock.dup())
+            return sock
+        except Cancel.CancelledError:
+            sock.close()
+            raise
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error or OSError('No address found for ' + host)
+
+
+
+
+class Response:
+    """The result of a request.
+    """
+
+
+    def __init__(self, url, status, headers, body):
+        """Initialize a response.
+        :param url: URL that was finally requested.
+        :param status: HTTP status code.
+        :param headers: Response headers.
+        :param body: Decoded response body.
+        """
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+
+
+class Pool:
+    """Idle keep-alive connections to one server.
+    """
+
+
+    def __init__(self, scheme, netloc, size, timeout):
+        """Initialize a connection pool.
+        :param scheme: 'http' or 'https'.
+        :param netloc: host[:port] of the server.
+        :param size: Maximum number of simultaneous connections.
+        :param timeout: Default socket timeout in seconds.
+        """
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+
+    def connect(self):
+        """Open a new connection to the server.
+        """
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+
+    def acquire(self, token=None):
+        """Returns (connection, reused), waiting for a free slot if needed.
+        :param token: Cancel.CancelToken that stops the wait.
+        """
+        if token is None:
+            self.slots.acquire()
+        else:
+            while not self.slots.acquire(timeout=Cancel.POLLINTERVAL):
+                token.check()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connect(), False
+
+
+    def release(self, conn, reusable):
+        """Hand a connection back to the pool.
+        :param conn: The connection.
+        :param reusable: False if the connection must be closed.
+        """
+        if reusable:
+            with self.lock:
+                self.idle.append(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+
+    def close(self):
+        """Close every idle connection.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+
+
+class Client:
+    """HTTP client with a keep-alive connection pool per server.
+    """
+
+
+    def __init__(self, poolSize=4, timeout=30, compress=True, maxRedirects=5):
+        """Initialize a client.
+        :param poolSize: Maximum number of connections per server.
+        :param timeout: Default timeout of a request in seconds.
+        :param compress: Ask servers for gzip encoded responses.
+        :param maxRedirects: Redirects followed before giving up.
+        """
+        self.poolSize = poolSize
+        self.timeout = timeout
+        self.compress = compress
+        self.maxRedirects = maxRedirects
+        self.pools = {}
+        self.lock = threading.Lock()
+
+        # Counters
+        self.requests = 0
+        self.bytesReceived = 0
+        self.bytesDecoded = 0
+        self.latency = 0.0
+        self.reused = 0
+
+
+    def pool(self, scheme, netloc):
+        """Returns the pool for a server, creating it if needed.
+        """
+        with self.lock:
+            key = (scheme, netloc)
+            if key not in self.pools:
+                self.pools[key] = Pool(scheme, netloc, self.poolSize, self.timeout)
+            return self.pools[key]
+
+
+    def send(self, url, headers, timeout, sink=None, token=None):
+        """Perform a single request without following redirects.
+        :param sink: File object successful response bodies are streamed
+                     into instead of being kept in memory.
+        :param token: Cancel.CancelToken; cancelling it shuts the socket
+                      down and the request raises Cancel.CancelledError.
+        """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise HttpError('Unsupported URL: ' + url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        sendHeaders = {'Connection': 'keep-alive'}
+        if self.compress:
+            sendHeaders['Accept-Encoding'] = 'gzip'
+        sendHeaders.update(headers)
+
+        pool = self.pool(parts.scheme, parts.netloc)
+        started = time.monotonic()
+        while True:
+            Cancel.check(token)
+            conn, reused = pool.acquire(token)
+            sockets = []
+            # Connect through connectSocket so a cancel stops the TCP
+            # connect. The TLS handshake runs on a socket the connection
+            # has not stored yet, it is stopped through a duplicate.
+            connecting = []
+            conn._create_connection = \
+                lambda address, timeout, source=None: \
+                connectSocket(address, timeout, source, token, connecting)
+            with Cancel.onCancel(token,
+                                 lambda: abortSockets(sockets + connecting)):
+                try:
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    try:
+                        conn.request('GET', path, headers=sendHeaders)
+                    finally:
+                        for sock in connecting:
+                            sock.close()
+                    # The connection forgets its socket when the response
+                    # says it will close, the body is still read from it
+                    sockets.append(conn.sock)
+                    # Cancelled while looking up the name, before there
+                    # was a socket
+                    Cancel.check(token)
+                    response = conn.getresponse()
+                except STALEERRORS:
+                    pool.release(conn, False)
+                    if reused and not Cancel.cancelled(token):
+                        # The server dropped an idle connection, try a new one
+                        continue
+                    Cancel.check(token)
+                    raise
+                except Exception:
+                    pool.release(conn, False)
+                    Cancel.check(token)
+                    raise
+                try:
+                    received, decoded, body = self.readBody(response, sink)
+                    # A shut down socket can look like the end of the body
+                    Cancel.check(token)
+                except Exception:
+                    pool.release(conn, False)
+                    Cancel.check(token)
+                    raise
+            pool.release(conn, not response.will_close)
+            break
+
+        with self.lock:
+            self.requests += 1
+            self.bytesReceived += received
+            self.bytesDecoded += decoded
+            self.latency += time.monotonic() - started
+            if reused:
+                self.reused += 1
+        return Response(url, response.status, response.msg, body)
+
+
+    def readBody(self, response, sink):
+        """Read a response body, decoding gzip.
+        Returns (bytes received, bytes decoded, body). The body is empty if
+        it was streamed into sink.
+        """
+        gzipped = response.getheader('Content-Encoding', '').lower() == 'gzip'
+        if sink is None or not 200 <= response.status < 300:
+            raw = response.read()
+            body = gzip.decompress(raw) if gzipped else raw
+            return len(raw), len(body), body
+
+        received = 0
+        decoded = 0
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        while True:
+            chunk = response.read(CHUNKSIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+            if decoder is not None:
+                chunk = decoder.decompress(chunk)
+            decoded += len(chunk)
+            sink.write(chunk)
+        if decoder is not None:
+            chunk = decoder.flush()
+            decoded += len(chunk)
+            sink.write(chunk)
+        return received, decoded, b''
+
+
+    def request(self, url, headers=None, timeout=None, sink=None, token=None):
+        """Request a URL, following redirects.
+        :param url: Absolute http or https URL.
+        :param headers: Extra request headers.
+        :param timeout: Timeout in seconds, the client default if None.
+        :param sink: File object a successful body is streamed into.
+        :param token: Cancel.CancelToken aborting the request.
+        Returns a Response whatever the status code.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        headers = headers or {}
+        for redirect in range(self.maxRedirects + 1):
+            response = self.send(url, headers, timeout, sink, token)
+            location = response.headers.get('Location')
+            if response.status not in REDIRECTS or not location:
+                return response
+            url = urllib.parse.urljoin(url, location)
+        raise HttpError('Too many redirects: ' + url)
+
+
+    def get(self, url, headers=None, timeout=None, token=None):
+        """Returns the body of a URL.
+        :param url: Absolute http or https URL.
+        :param headers: Extra request headers.
+        :param timeout: Timeout in seconds, the client default if None.
+        :param token: Cancel.CancelToken aborting the request.
+        """
+        response = self.request(url, headers, timeout, token=token)
+        if response.status >= 400:
+            raise HttpError('%s returned %d' % (url, response.status),
+                            response.status)
+        return response.body
+
+
+    def download(self, url, filename, timeout=None, token=None):
+        """Save the body of a URL to a file.
+        :param url: Absolute http or https URL.
+        :param filename: Where to save it.
+        :param timeout: Timeout in seconds, the client default if None.
+        :param token: Cancel.CancelToken aborting the download.
+        The body is streamed to disk, never held in memory as a whole. It
+        goes to a temporary file next to filename first, so a failed or
+        cancelled download leaves nothing behind.
+        """
+        directory, name = os.path.split(filename)
+        fd, tmp = tempfile.mkstemp(dir=directory or '.',
+                                   prefix='.' + name + '-')
+        try:
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, 'wb') as f:
+                response = self.request(url, timeout=timeout, sink=f,
+                                        token=token)
+            if response.status >= 400:
+                raise HttpError('%s returned %d' % (url, response.status),
+                                response.status)
+            os.replace(tmp, filename)
+        except:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+
+    def stats(self):
+        """Returns the client's counters.
+        """
+        with self.lock:
+            s = {}
+            s['requests'] = self.requests
+            s['reused'] = self.reused
+            s['bytesReceived'] = self.bytesReceived
+            s['bytesDecoded'] = self.bytesDecoded
+            s['latency'] = self.latency
+            if self.requests:
+                s['averageLatency'] = self.latency / self.requests
+            else:
+                s['averageLatency'] = 0.0
+            return s
+
+
+    def close(self):
+        """Close all idle connections.
+        """
+        with self.lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            pool.close()
+
+
+
+
+# vim: set ts=4 sw=4 noet:
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# Reads pacman's local database (/var/lib/pacman/local/*/desc) to find out
+# which packages are installed without asking pacman every time.
+
+import os
+import threading
+
+from .SyncDb import parseDesc, depName
+
+LOCALPATH = '/var/lib/pacman/local'
+
+# Values of %REASON% in a local desc entry
+EXPLICIT = 'explicit'
+DEPEND = 'depend'
+
+
+def readEntry(path):
+    """Read one package directory of the local database.
+    :param path: Path to the <name>-<version> directory.
+    Returns a package dictionary or None if the entry is unusable.
+    """
+    fields = {}
+    for entry in ('desc', 'depends'):
+        try:
+            with open(os.path.join(path, entry), encoding='utf-8',
+                      errors='replace') as f:
+                fields.update(parseDesc(f.read()))
+        except (IOError, OSError):
+            continue
+    if not fields.get('NAME'):
+        return None
+
+    d = {}
+    d['Name'] = fields['NAME'][0]
+    d['Version'] = fields.get('VERSION', [''])[0]
+    d['Description'] = fields.get('DESC', [''])[0]
+    d['provides'] = list(fields.get('PROVIDES', []))
+    if fields.get('REASON', ['0'])[0] == '1':
+        d['reason'] = DEPEND
+    else:
+        d['reason'] = EXPLICIT
+    return d
+
+
+class LocalDb:
+    """The set of installed packages.
+    The database is only re-read when the directory's mtime changes, which
+    happens whenever pacman adds or removes a package entry.
+    """
+
+
+    def __init__(self, path=LOCALPATH):
+        """Initialize a local database reader.
+        :param path: Directory holding the local database.
+        """
+        self.path = path
+        self.packages = {}
+        self.explicit = frozenset()
+        self.all = frozenset()
+        self.provided = frozenset()
+        self.stamp = None
+        self.lock = threading.Lock()
+
+
+    def load(self):
+        """(Re)read the database if the directory changed on disk.
+        """
+        with self.lock:
+            try:
+                stamp = os.stat(self.path).st_mtime_ns
+            except OSError:
+                stamp = None
+            if stamp == self.stamp:
+                return
+            packages = {}
+            if stamp is not None:
+                for entry in os.listdir(self.path):
+                    entryPath = os.path.join(self.path, entry)
+                    if not os.path.isdir(entryPath):
+                        continue
+                    d = readEntry(entryPath)
+                    if d is not None:
+                        packages[d['Name']] = d
+            self.packages = packages
+            self.all = frozenset(packages)
+            self.explicit = frozenset(n for n, d in packages.items()
+                                      if d['reason'] == EXPLICIT)
+            self.provided = frozenset(depName(p) for d in packages.values()
+                                      for p in d['provides'])
+            self.stamp = stamp
+
+
+    def available(self):
+        """Returns True if the local database could be read.
+        """
+        self.load()
+        return self.stamp is not None
+
+
+    def getInstalled(self, explicitOnly=True):
+        """Returns the set of installed package names.
+        :param explicitOnly: Leave out packages installed as dependencies.
+        """
+        self.load()
+        if explicitOnly:
+            return self.explicit
+        return self.all
+
+
+    def getPkgInfo(self, name):
+        """Returns name, version, description and install reason of an
+        installed package, or None if it is not installed.
+        :param name: Name of the package.
+        """
+        self.load()
+        d = self.packages.get(name)
+        if d is None:
+            return None
+        return dict(d)
+
+
+    def satisfies(self, name):
+        """Returns True if an installed package is or provides name.
+        :param name: Package name, without version constraint.
+        """
+        self.load()
+        return name in self.all or name in self.provided
+
+
+    def __contains__(self, name):
+        self.load()
+        return name in self.all
+
+
+
+
+_localDb = None
+_localDbLock = threading.Lock()
+
+def getLocalDb():
+    """Returns the shared LocalDb instance.
+    """
+    global _localDb
+    with _localDbLock:
+        if _localDb is None:
+            _localDb = LocalDb()
+        return _localDb
+
+
+
+
+# vim: set ts=4 sw=4 noet:
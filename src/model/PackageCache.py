@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# Keeps the packages makepkg built, keyed by the build files they were
+# made from, so an unchanged PKGBUILD is never built twice.
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from . import Cache
+from . import Srcinfo
+
+# Upper bound of the cache size in bytes
+MAXSIZE = 2 * 1024 * 1024 * 1024
+
+METAFILE = 'entry.json'
+
+
+def isBuildOutput(name):
+    """Returns True for files makepkg creates, which are not build inputs.
+    """
+    return '.pkg.tar' in name or name.endswith('.log')
+
+
+def buildKey(directory, arch=None):
+    """Returns the cache key of the package in directory: a hash over the
+    PKGBUILD, every other file next to it and the target architecture.
+    :param directory: Build directory, before makepkg ran in it.
+    :param arch: Target architecture, the current one if None.
+    """
+    if arch is None:
+        arch = Srcinfo.currentArch()
+    h = hashlib.sha256()
+    h.update(arch.encode('utf-8') + b'\0')
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if isBuildOutput(name) or not os.path.isfile(path):
+            continue
+        h.update(os.fsencode(name) + b'\0')
+        with open(path, 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+def linkOrCopy(source, destination):
+    """Hard link source to destination, copying if they are on different
+    filesystems.
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class PackageCache:
+    """Size-bounded, least recently used, on-disk cache of built packages.
+    Every entry is a directory named after its key holding the package
+    files and an entry.json describing them.
+    """
+
+
+    def __init__(self, path=None, maxSize=MAXSIZE):
+        """Initialize a package cache.
+        :param path: Directory of the cache, CACHEDIR/packages if None.
+        :param maxSize: Size in bytes above which old entries are evicted.
+        """
+        if path is None:
+            path = os.path.join(Cache.CACHEDIR, 'packages')
+        self.path = path
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def entryPath(self, key):
+        return os.path.join(self.path, key)
+
+
+    def lookup(self, key):
+        """Returns the package files cached under key, or None.
+        """
+        directory = self.entryPath(key)
+        try:
+            with open(os.path.join(directory, METAFILE), encoding='utf-8') as f:
+                meta = json.load(f)
+            files = [os.path.join(directory, n) for n in meta['files']]
+        except (IOError, OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        if not all(os.path.isfile(p) for p in files):
+            self.misses += 1
+            return None
+        try:
+            os.utime(directory)
+        except OSError:
+            pass
+        self.hits += 1
+        return files
+
+
+    def fetch(self, key, directory):
+        """Place the packages cached under key in directory.
+        Returns the paths of the placed files, or None on a miss.
+        """
+        files = self.lookup(key)
+        if files is None:
+            return None
+        result = []
+        for source in files:
+            destination = os.path.join(directory, os.path.basename(source))
+            if os.path.exists(destination):
+                os.unlink(destination)
+            linkOrCopy(source, destination)
+            result.append(destination)
+        return result
+
+
+    def store(self, key, name, files):
+        """Add freshly built packages to the cache.
+        The cache is best effort, failures to write are ignored.
+        :param key: Output of buildKey for the package's build files.
+        :param name: Name of the package, for listings.
+        :param files: Paths of the package files.
+        """
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp = tempfile.mkdtemp(dir=self.path, prefix='.tmp-')
+            try:
+                for source in files:
+                    linkOrCopy(source, os.path.join(tmp, os.path.basename(source)))
+                meta = {}
+                meta['name'] = name
+                meta['stored'] = time.time()
+                meta['files'] = [os.path.basename(p) for p in files]
+                with open(os.path.join(tmp, METAFILE), 'w', encoding='utf-8') as f:
+                    json.dump(meta, f)
+                # A concurrent build of the same key may have won the race
+                os.rename(tmp, self.entryPath(key))
+            except OSError:
+                shutil.rmtree(tmp, True)
+                return
+            self.evict()
+        except (IOError, OSError):
+            pass
+
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.entryPath(key), METAFILE))
+
+
+    def entries(self):
+        """Returns a list of dictionaries (key, name, files, size, used),
+        least recently used first.
+        """
+        result = []
+        try:
+            keys = os.listdir(self.path)
+        except OSError:
+            return result
+        for key in keys:
+            if key.startswith('.'):
+                continue
+            directory = self.entryPath(key)
+            try:
+                with open(os.path.join(directory, METAFILE), encoding='utf-8') as f:
+                    meta = json.load(f)
+                size = 0
+                for n in os.listdir(directory):
+                    size += os.stat(os.path.join(directory, n)).st_size
+                used = os.stat(directory).st_mtime
+            except (IOError, OSError, ValueError):
+                continue
+            d = {}
+            d['key'] = key
+            d['name'] = meta.get('name', '')
+            d['files'] = meta.get('files', [])
+            d['size'] = size
+            d['used'] = used
+            result.append(d)
+        result.sort(key=lambda d: d['used'])
+        return result
+
+
+    def remove(self, key):
+        """Remove one entry.
+        """
+        shutil.rmtree(self.entryPath(key), True)
+
+
+    def evict(self, maxSize=None):
+        """Remove least recently used entries until the cache fits maxSize.
+        :param maxSize: Size limit in bytes, self.maxSize if None.
+        Returns the removed entries.
+        """
+        if maxSize is None:
+            maxSize = self.maxSize
+        removed = []
+        with self.lock:
+            entries = self.entries()
+            total = sum(d['size'] for d in entries)
+            for d in entries:
+                if total <= maxSize:
+                    break
+                self.remove(d['key'])
+                total -= d['size']
+                removed.append(d)
+        return removed
+
+
+    def clear(self):
+        """Remove every entry.
+        """
+        return self.evict(0)
+
+
+
+
+_packageCache = None
+_packageCacheLock = threading.Lock()
+
+def getPackageCache():
+    """Returns the shared PackageCache instance.
+    """
+    global _packageCache
+    with _packageCacheLock:
+        if _packageCache is None:
+            _packageCache = PackageCache()
+        return _packageCache
+
+
+
+
+if (__name__ == "__main__"):
+
+    from .SyncDb import humanSize
+
+    usage = 'usage: python3 -m model.PackageCache list | prune [MiB] | clear'
+    command = sys.argv[1] if len(sys.argv) > 1 else 'list'
+    cache = getPackageCache()
+    if command == 'list':
+        entries = cache.entries()
+        for d in reversed(entries):
+            print('%s  %-30s %10s  %s' % (d['key'][:12], d['name'],
+                  humanSize(d['size']),
+                  time.strftime('%Y-%m-%d %H:%M', time.localtime(d['used']))))
+        print('%d entries, %s' % (len(entries),
+              humanSize(sum(d['size'] for d in entries))))
+    elif command in ('prune', 'clear'):
+        if command == 'clear':
+            removed = cache.clear()
+        elif len(sys.argv) > 2:
+            removed = cache.evict(int(sys.argv[2]) * 1024 * 1024)
+        else:
+            removed = cache.evict()
+        print('Removed %d entries, %s' % (len(removed),
+              humanSize(sum(d['size'] for d in removed))))
+    else:
+        sys.exit(usage)
+
+
+
+
+# vim: set ts=4 sw=4 noet:
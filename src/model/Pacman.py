@@ -22,7 +22,20 @@
 
 # TODO: this file should be replaced with calls to libalpm/pyalpm
 
-import os, subprocess
+import os, glob, subprocess
+
+from . import SyncDb
+from . import LocalDb
+from . import Progress
+from . import Cancel
+
+
+# Lock pacman holds while it changes the databases or the system
+LOCKFILE = '/var/lib/pacman/db.lck'
+
+# Seconds a cancelled pacman gets to roll back and release LOCKFILE
+# before it is killed
+KILLDELAY = 10
 
 
 class PackageError(Exception):
@@ -43,35 +56,80 @@ class NotFoundError(Exception):
         return repr(self.value)
 
 
-def sync():
+def removeStaleLock():
+    """Remove the lock a killed pacman left behind. Only called right
+    after our own pacman, which held it, was killed.
+    """
+    try:
+        os.unlink(LOCKFILE)
+    except FileNotFoundError:
+        pass
+
+
+def sync(token=None):
     """Syncs remote database with the local database.
+    :param token: Cancel.CancelToken interrupting pacman, see runPacman.
     """
     if (os.geteuid() != 0):
         raise PackageError("Must be root to perform this action")
     else:
-        output = subprocess.call(["pacman", "-Syy"])
+        output = Cancel.call(["pacman", "-Syy"], token, KILLDELAY,
+                             removeStaleLock)
 
 
-def getInstalled():
-    """Get a list of installed applications.
+def getInstalled(explicitOnly=True):
+    """Get the set of explicitly installed applications.
+    :param explicitOnly: Leave out packages installed as dependencies.
     """
-    cmdOutput = subprocess.check_output(["pacman", "-Qeq"])
+    db = LocalDb.getLocalDb()
+    if db.available():
+        return db.getInstalled(explicitOnly)
+
+    if explicitOnly:
+        cmdOutput = subprocess.check_output(["pacman", "-Qeq"])
+    else:
+        cmdOutput = subprocess.check_output(["pacman", "-Qq"])
     cmdOutput = cmdOutput.decode("utf-8")
     installed = cmdOutput.splitlines()
-    rList = []
+    rSet = set()
     for app in installed:
-        rList.append(str(app))
-    return rList
+        rSet.add(str(app))
+    return rSet
+
+
+def getSatisfied(names):
+    """Returns the subset of names that installed packages are or provide.
+    :param names: Package names, without version constraints.
+    """
+    db = LocalDb.getLocalDb()
+    if db.available():
+        return set(n for n in names if db.satisfies(n))
+    installedSet = getInstalled(False)
+    return set(n for n in names if n in installedSet)
+
+
+def getProviders(names, token=None):
+    """Find the repository packages that are or provide each name.
+    :param names: Package names, without version constraints.
+    :param token: Cancel.CancelToken interrupting pacman.
+    Returns a dictionary mapping each satisfiable name to the package
+    pacman -S would pick for it.
+    """
+    db = SyncDb.getSyncDb()
+    if db.available():
+        result = {}
+        for name in names:
+            d = db.findProvider(name)
+            if d is not None:
+                result[name] = d
+        return result
+    return getPkgInfoMany(names, token)
 
 
 def installed(name):
     """Returns if specific package is installed or not
     """
-    installedList = getInstalled()
-    if name in installedList:
-        return True
-    else:
-        return False
+    return name in getInstalled()
 
 
 def remove(name):
@@ -80,11 +138,39 @@ def remove(name):
     """
     if not installed(name):
         raise PackageError(name + ' is not installed.')
-    else:
-        if (os.geteuid() != 0):
-            raise PackageError("Must be root to perform this action")
-        else:
-            output = subprocess.call(["pacman", "--noconfirm", "-R", name])
+    removeMany([name])
+
+
+def runPacman(args, progress=None, sizes=None, token=None):
+    """Run a pacman command line.
+    :param args: Command line.
+    :param progress: Called with a Progress.Event for every progress line
+                     of pacman's output; the output goes to the terminal
+                     if None.
+    :param sizes: Download sizes of the packages involved, by name.
+    :param token: Cancel.CancelToken interrupting pacman. pacman gets
+                  KILLDELAY seconds to stop cleanly; if it has to be
+                  killed its stale lock is removed.
+    Returns the exit status.
+    """
+    if progress is None:
+        return Cancel.call(args, token, KILLDELAY, removeStaleLock)
+    return Progress.run(args, progress, sizes, token, KILLDELAY,
+                        removeStaleLock)
+
+
+def removeMany(names, progress=None, token=None):
+    """Remove several packages in a single pacman transaction.
+    :param names: Names of the packages to remove.
+    :param progress: Progress callback, see runPacman.
+    :param token: Cancel.CancelToken, see runPacman.
+    """
+    if (os.geteuid() != 0):
+        raise PackageError("Must be root to perform this action")
+    retValue = runPacman(["pacman", "--noconfirm", "-R"] + list(names),
+                         progress, token=token)
+    if retValue != 0:
+        raise PackageError("Removing " + ", ".join(names) + " failed")
 
 
 def upgrade():
@@ -96,16 +182,21 @@ def upgrade():
         output = subprocess.call(["pacman", "-Syyu", "--noconfirm"])
 
 
-def toBeUpgraded():
+def toBeUpgraded(token=None):
     """Returns list of packages to be upgraded.
+    :param token: Cancel.CancelToken interrupting pacman.
     """
     result = []
     try:
-        output = subprocess.check_output(["pacman", "-Quq"])
+        output = Cancel.checkOutput(["pacman", "-Quq"], token)
         output = output.decode("utf-8")
         output = output.splitlines()
+        infos = getPkgInfoMany(output, token)
         for app in output:
-            result.append(getPkgInfo(app))
+            if app in infos:
+                result.append(infos[app])
+    except Cancel.CancelledError:
+        raise
     except:
         result = []
     return result
@@ -115,72 +206,200 @@ def install(name):
     """Installs a given package.
     :param name: Name of package to install.
     """
+    installMany([name])
+
+
+def installMany(names, asDeps=False, progress=None, token=None):
+    """Install or upgrade several repository packages in a single pacman
+    transaction.
+    :param names: Names of the packages.
+    :param asDeps: Mark newly installed packages as dependencies.
+    :param progress: Progress callback, see runPacman.
+    :param token: Cancel.CancelToken, see runPacman.
+    """
     if (os.geteuid() != 0):
         raise PackageError("Must be root to perform this action")
-    else:
-        retValue = subprocess.call(["pacman", "--noconfirm", "-S", name])
+    args = ["pacman", "--noconfirm", "-S"]
+    if asDeps:
+        args.append("--asdeps")
+    sizes = None
+    if progress is not None:
+        syncDb = SyncDb.getSyncDb()
+        if syncDb.available():
+            infos = [syncDb.getPkgInfo(n) for n in names]
+            sizes = dict((d['Name'], d['csize']) for d in infos if d)
+    retValue = runPacman(args + list(names), progress, sizes, token)
     if retValue != 0:
-        raise PackageError("Package does not exist")
+        raise PackageError("Installing " + ", ".join(names) + " failed")
+
+
+def builtPackages(directory):
+    """Returns the package files makepkg created in directory.
+    :param directory: Build directory of a package.
+    """
+    pattern = os.path.join(directory, '*.pkg.tar*')
+    return sorted(p for p in glob.glob(pattern) if not p.endswith('.sig'))
 
 
-def installLocal(name):
-    """Install a package located locally.
-    :param name: Name of the package to install.
+def installLocal(directory):
+    """Install the packages built in a local directory.
+    :param directory: Build directory holding the package files.
+    """
+    files = builtPackages(os.path.abspath(directory))
+    if not files:
+        raise PackageError("No package built in " + directory)
+    installFiles(files)
+
+
+def installFiles(paths, asDeps=False, progress=None, token=None):
+    """Install built package files in a single pacman transaction.
+    :param paths: Paths of the package files.
+    :param asDeps: Mark the installed packages as dependencies.
+    :param progress: Progress callback, see runPacman.
+    :param token: Cancel.CancelToken, see runPacman.
     """
     if (os.geteuid() != 0):
         raise PackageError("Must be root to perform this action")
-    else:
-        if not os.path.exists(name):
-            os.makedirs(name)
-        os.chdir(name)
-        retValue = subprocess.call(["pacman", "-U", "--noconfirm", name])
-        os.chdir('../')
+    args = ["pacman", "-U", "--noconfirm"]
+    if asDeps:
+        args.append("--asdeps")
+    retValue = runPacman(args + list(paths), progress, token=token)
     if retValue != 0:
-        raise PackageError("Package does not exist")
+        raise PackageError("Installing " + ", ".join(paths) + " failed")
+
+
+# Fields of pacman -Si output and the keys potluck stores them under
+PKGINFOKEYS = {
+    'Repository': 'repo',
+    'Name': 'Name',
+    'Version': 'Version',
+    'Description': 'Description',
+    'Download Size': 'dsize',
+    'Installed Size': 'isize',
+}
+
+
+def argMax():
+    """Returns how many bytes of arguments may safely be passed to exec.
+    """
+    try:
+        limit = os.sysconf('SC_ARG_MAX')
+    except (ValueError, OSError):
+        limit = 131072
+    envSize = sum(len(k) + len(v) + 2 for k, v in os.environ.items())
+    # Leave generous room for the environment and pointer overhead
+    return max(4096, (limit - envSize) // 2)
+
+
+def chunkArgs(names, limit=None):
+    """Split a list of arguments into chunks that stay under ARG_MAX.
+    :param names: Arguments to split.
+    :param limit: Maximum number of bytes per chunk.
+    """
+    if limit is None:
+        limit = argMax()
+    chunk = []
+    size = 0
+    for name in names:
+        # Each argument costs its bytes, a NUL and an argv pointer
+        cost = len(name.encode('utf-8')) + 1 + 8
+        if chunk and size + cost > limit:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(name)
+        size += cost
+    if chunk:
+        yield chunk
+
+
+def parsePkgInfo(lines):
+    """Parse multi-record pacman -Si output.
+    :param lines: Iterable of output lines.
+    Yields one dictionary per package record.
+    """
+    d = {}
+    for line in lines:
+        line = line.rstrip('\n')
+        if line.strip() == '':
+            if d:
+                yield d
+            d = {}
+            continue
+        if line[0].isspace():
+            # Continuation of a multi-line value
+            continue
+        key, sep, value = line.partition(':')
+        key = key.strip()
+        if sep and key in PKGINFOKEYS:
+            d[PKGINFOKEYS[key]] = value.strip()
+    if d:
+        yield d
+
+
+def getPkgInfoMany(names, token=None):
+    """Get information about several packages at once.
+    :param names: Names of packages to get information about.
+    :param token: Cancel.CancelToken interrupting pacman.
+    Returns a dictionary mapping each found name to its information.
+    """
+    names = [n for n in dict.fromkeys(names) if n]
+    result = {}
+    if not names:
+        return result
+
+    db = SyncDb.getSyncDb()
+    if db.available():
+        for name in names:
+            d = db.getPkgInfo(name)
+            if d is not None:
+                result[name] = d
+        return result
+
+    env = dict(os.environ)
+    env['LC_ALL'] = 'C'
+    for chunk in chunkArgs(names):
+        # Missing packages make pacman exit non-zero but the records of
+        # the packages that were found are still printed
+        with Cancel.process(["pacman", "-Si"] + chunk, token, env=env,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            encoding='utf-8') as proc:
+            for d in parsePkgInfo(proc.stdout):
+                if 'Name' in d and d['Name'] not in result:
+                    result[d['Name']] = d
+    return result
 
 
 def getPkgInfo(name):
     """Get information about a given package.
     :param name: Name of package to get information about.
     """
-    d = {}
-    try:
-        info = subprocess.check_output(["pacman", "-Si", name])
-        info = info.decode("utf-8")
-        info = info.splitlines()
-        for line in info:
-            if line[0:10] == 'Repository':
-                d['repo'] = str(line[17:])
-            if line[0:4] == 'Name':
-                d['Name'] = str(line[17:])
-            if line[0:13] == 'Download Size':
-                d['dsize'] = line[17:]
-            if line[0:14] == 'Installed Size':
-                d['isize'] = line[17:]
-            if line[0:11] == 'Description':
-                d['Description'] = str(line[17:])
-        return d
-    except subprocess.CalledProcessError:
-        return None
-    
+    return getPkgInfoMany([name]).get(name)
+
 
-def search(term):
+def search(term, token=None):
     """Search for a package.
     :param term: Term to search for.
+    :param token: Cancel.CancelToken interrupting pacman.
     """
+    db = SyncDb.getSyncDb()
+    if db.available():
+        return db.search(term)
+
     result = []
 
     try:
-        output = subprocess.check_output(["pacman", "-Ssq", term])
+        output = Cancel.checkOutput(["pacman", "-Ssq", term], token)
         output = output.decode("utf-8")
     except subprocess.CalledProcessError:
         output = ''
 
-    matches = output.splitlines()
-   
+    matches = [m for m in dict.fromkeys(output.splitlines()) if m != '']
+    infos = getPkgInfoMany(matches, token)
     for match in matches:
-        if match != '':
-            result.append(getPkgInfo(match))
+        if match in infos:
+            result.append(infos[match])
     return result
 
 
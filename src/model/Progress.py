@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# Structured progress of a commit, parsed from pacman's output.
+
+import os
+import re
+import time
+import threading
+import subprocess
+
+from . import Cancel
+
+# Phases an Event can be in
+DOWNLOAD = 'download'
+VERIFY = 'verify'
+PREPARE = 'prepare'
+INSTALL = 'install'
+REMOVE = 'remove'
+BUILD = 'build'
+
+# Beginnings of pacman's "(n/m) <action>" lines and their phases
+ACTIONS = [
+    ('installing ', INSTALL),
+    ('upgrading ', INSTALL),
+    ('reinstalling ', INSTALL),
+    ('downgrading ', INSTALL),
+    ('removing ', REMOVE),
+    ('checking keys', VERIFY),
+    ('checking package integrity', VERIFY),
+    ('loading package files', PREPARE),
+    ('checking for file conflicts', PREPARE),
+    ('checking available disk space', PREPARE),
+]
+
+UNITS = {'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+
+STEPLINE = re.compile(r'^\(\s*(\d+)/\s*(\d+)\) (.*)$')
+DOWNLOADLINE = re.compile(r'^(?:downloading (\S+?)(?:\.\.\.)?|\s*(\S+) downloading\.\.\.)$')
+DOWNLOADSIZE = re.compile(r'^Total Download Size:\s*([\d.]+)\s*(\S+)')
+
+# Seconds between two events passed on by a Throttle
+INTERVAL = 0.1
+
+
+class Event:
+    """One progress update of a commit.
+    """
+
+
+    def __init__(self, phase, package='', current=0, total=0, bytesDone=0,
+                 bytesTotal=0, message=''):
+        """Initialize an event.
+        :param phase: One of the phase constants.
+        :param package: Package the event is about, if any.
+        :param current: Packages of the commit done so far.
+        :param total: Packages the commit touches.
+        :param bytesDone: Bytes downloaded so far.
+        :param bytesTotal: Bytes to download, 0 if unknown.
+        :param message: Human readable description.
+        """
+        self.phase = phase
+        self.package = package
+        self.current = current
+        self.total = total
+        self.bytesDone = bytesDone
+        self.bytesTotal = bytesTotal
+        self.message = message
+
+
+    def __repr__(self):
+        return 'Event(%r, %r, %d/%d, %d/%d bytes)' % (self.phase,
+               self.package, self.current, self.total, self.bytesDone,
+               self.bytesTotal)
+
+
+
+
+def packageName(filename):
+    """Strip version, release, architecture and extension from a package
+    file name, e.g. 'zlib-1:1.2.11-4-x86_64.pkg.tar.zst' becomes 'zlib'.
+    """
+    return filename.split('.pkg.tar', 1)[0].rsplit('-', 3)[0]
+
+
+class PacmanParser:
+    """Turns the lines pacman prints (without a terminal, so without
+    progress bars) into Events.
+    """
+
+
+    def __init__(self, sizes=None):
+        """Initialize a parser.
+        :param sizes: Dictionary mapping package names to download sizes
+                      in bytes, used to estimate download progress.
+        """
+        self.sizes = sizes or {}
+        self.phase = PREPARE
+        self.current = 0
+        self.total = 0
+        self.bytesDone = 0
+        self.bytesTotal = sum(self.sizes.values())
+        self.downloading = None
+
+
+    def event(self, package='', message=''):
+        return Event(self.phase, package, self.current, self.total,
+                     self.bytesDone, self.bytesTotal, message)
+
+
+    def finishDownload(self):
+        if self.downloading is not None:
+            self.bytesDone += self.sizes.get(self.downloading, 0)
+            self.downloading = None
+
+
+    def feed(self, line):
+        """Parse one line of output.
+        Returns an Event, or None if the line says nothing about progress.
+        """
+        line = line.rstrip()
+        m = DOWNLOADSIZE.match(line)
+        if m:
+            try:
+                self.bytesTotal = int(float(m.group(1)) * UNITS.get(m.group(2), 1))
+            except ValueError:
+                pass
+            return None
+        m = DOWNLOADLINE.match(line)
+        if m:
+            self.finishDownload()
+            self.phase = DOWNLOAD
+            self.downloading = packageName(m.group(1) or m.group(2))
+            return self.event(self.downloading, 'Downloading ' + self.downloading)
+        m = STEPLINE.match(line)
+        if m:
+            self.finishDownload()
+            action = m.group(3)
+            for prefix, phase in ACTIONS:
+                if action.startswith(prefix):
+                    break
+            else:
+                return None
+            if self.phase == DOWNLOAD:
+                self.bytesDone = max(self.bytesDone, self.bytesTotal)
+            self.phase = phase
+            package = ''
+            if phase in (INSTALL, REMOVE):
+                self.current = int(m.group(1))
+                self.total = int(m.group(2))
+                package = action.split(' ', 1)[1].split(' ', 1)[0]
+            return self.event(package, action[0].upper() + action[1:])
+        return None
+
+
+
+
+def run(args, callback, sizes=None, token=None, killDelay=Cancel.KILLDELAY,
+        onKill=None):
+    """Run pacman, passing an Event to callback for every progress line.
+    :param args: Command line.
+    :param callback: Called with each Event.
+    :param sizes: Download sizes for PacmanParser.
+    :param token: Cancel.CancelToken interrupting pacman.
+    :param killDelay: Seconds pacman gets to exit on a cancel.
+    :param onKill: Called if pacman had to be killed, see Cancel.process.
+    Returns the exit status.
+    """
+    env = dict(os.environ)
+    env['LC_ALL'] = 'C'
+    parser = PacmanParser(sizes)
+    with Cancel.process(args, token, killDelay, onKill, env=env,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        stdin=subprocess.DEVNULL) as proc:
+        for raw in proc.stdout:
+            event = parser.feed(raw.decode('utf-8', 'replace'))
+            if event is not None:
+                callback(event)
+    return proc.returncode
+
+
+class Throttle:
+    """Passes events on at most every interval seconds, always keeping the
+    latest one, so a chatty commit cannot flood a GUI event loop. Phase
+    changes are passed on right away.
+    """
+
+
+    def __init__(self, emit, interval=INTERVAL):
+        """Initialize a throttle.
+        :param emit: Called with the events that are passed on.
+        :param interval: Minimum number of seconds between two events.
+        """
+        self.emit = emit
+        self.interval = interval
+        self.last = 0.0
+        self.phase = None
+        self.pending = None
+        self.lock = threading.Lock()
+
+
+    def __call__(self, event):
+        now = time.monotonic()
+        with self.lock:
+            if event.phase == self.phase and now - self.last < self.interval:
+                self.pending = event
+                return
+            self.pending = None
+            self.phase = event.phase
+            self.last = now
+        self.emit(event)
+
+
+    def flush(self):
+        """Pass on the event held back last, if any.
+        """
+        with self.lock:
+            event = self.pending
+            self.pending = None
+        if event is not None:
+            self.emit(event)
+
+
+
+
+# vim: set ts=4 sw=4 noet:
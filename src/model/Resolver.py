@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# Expands AUR targets into their full dependency closure and orders the
+# AUR packages so every one is built after the ones it needs.
+
+from . import Aur
+from . import Pacman
+from . import Cancel
+from .SyncDb import depName
+
+
+class ResolveError(Exception):
+    """Exception that is raised when dependencies cannot be resolved.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+
+
+class Plan:
+    """The outcome of resolving a set of AUR targets.
+    """
+
+
+    def __init__(self, targets):
+        """Initialize an empty plan.
+        :param targets: AUR packages that were asked for.
+        """
+        self.targets = list(targets)
+        # AUR packages to build, dependencies first
+        self.order = []
+        # name -> Aur.Upgrade
+        self.upgrades = {}
+        # name -> set of AUR packages that must be built before it
+        self.edges = {}
+        # Repository packages the AUR packages need
+        self.repoDepends = []
+        # Dependency -> packages needing it, for deps found nowhere
+        self.missing = {}
+        # Number of graph levels, i.e. rounds of batched lookups
+        self.lookups = 0
+
+
+    def levels(self):
+        """Group the AUR packages by depth in the dependency graph.
+        Returns a list of lists; packages of a level only depend on
+        packages of earlier levels.
+        """
+        depth = {}
+        for name in self.order:
+            depth[name] = 1 + max([depth[d] for d in self.edges[name]] or [-1])
+        result = [[] for i in range(max(depth.values()) + 1)] if depth else []
+        for name in self.order:
+            result[depth[name]].append(name)
+        return result
+
+
+
+
+def topoSort(edges):
+    """Order nodes so that every node comes after the nodes it points to.
+    :param edges: Dictionary mapping each node to the nodes it needs.
+    Raises ResolveError naming the cycle if there is one.
+    """
+    order = []
+    state = {}
+    for root in edges:
+        if root in state:
+            continue
+        # Iterative depth first search, path holds the nodes being visited
+        path = [root]
+        stack = [iter(sorted(edges[root]))]
+        state[root] = 'visiting'
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+                done = path.pop()
+                state[done] = 'done'
+                order.append(done)
+                continue
+            if state.get(node) == 'visiting':
+                cycle = path[path.index(node):] + [node]
+                raise ResolveError('Dependency cycle: ' + ' -> '.join(cycle))
+            if node in state:
+                continue
+            state[node] = 'visiting'
+            path.append(node)
+            stack.append(iter(sorted(edges.get(node, ()))))
+    return order
+
+
+class Resolver:
+    """Resolves the dependencies of AUR packages level by level.
+    Each level costs one installed check, one repository lookup, one AUR
+    info lookup and the (parallel) PKGBUILD downloads of its packages,
+    however many edges it has.
+    """
+
+
+    def __init__(self, token=None):
+        """Initialize a resolver.
+        :param token: Cancel.CancelToken aborting the lookups and downloads.
+        """
+        self.satisfied = set()
+        self.repo = {}
+        self.token = token
+
+
+    def resolve(self, targets):
+        """Build the plan for a set of AUR targets.
+        :param targets: Names of AUR packages.
+        Raises ResolveError on dependency cycles or failed downloads, and
+        Cancel.CancelledError when the token is cancelled.
+        """
+        plan = Plan(targets)
+        level = list(dict.fromkeys(targets))
+        provided = {}
+        while level:
+            plan.lookups += 1
+            for r in Aur.getUpgrades(level, self.token):
+                if isinstance(r.error, Cancel.CancelledError):
+                    raise r.error
+                if not r.ok():
+                    raise ResolveError('Could not fetch %s: %s' % (r.item, r.error))
+                plan.upgrades[r.item] = r.value
+                plan.edges[r.item] = set()
+                for p in r.value.provides:
+                    provided.setdefault(depName(p), r.item)
+
+            needed = {}
+            for name in level:
+                upgrade = plan.upgrades[name]
+                for dep in upgrade.depends + upgrade.buildDepends:
+                    dep = depName(dep)
+                    if dep and dep != name:
+                        needed.setdefault(dep, []).append(name)
+
+            unknown = []
+            for dep, requirers in needed.items():
+                node = dep if dep in plan.upgrades else provided.get(dep)
+                if node is not None:
+                    for name in requirers:
+                        plan.edges[name].add(node)
+                elif dep in self.repo:
+                    if dep not in plan.repoDepends:
+                        plan.repoDepends.append(dep)
+                elif dep not in self.satisfied:
+                    unknown.append(dep)
+
+            self.satisfied |= Pacman.getSatisfied(unknown)
+            rest = [d for d in unknown if d not in self.satisfied]
+            repo = Pacman.getProviders(rest, self.token)
+            for dep in rest:
+                if dep in repo:
+                    self.repo[dep] = repo[dep]
+                    plan.repoDepends.append(dep)
+            rest = [d for d in rest if d not in repo]
+
+            failed = []
+            aur = Aur.getPkgInfoMany(rest, self.token, failed)
+            if failed:
+                raise ResolveError('Could not fetch %s: %s' %
+                                   (', '.join(failed[0].item), failed[0].error))
+            level = []
+            for dep in rest:
+                if dep in aur:
+                    level.append(dep)
+                    for name in needed[dep]:
+                        plan.edges[name].add(dep)
+                else:
+                    plan.missing[dep] = needed[dep]
+
+        plan.order = topoSort(plan.edges)
+        return plan
+
+
+
+
+# vim: set ts=4 sw=4 noet:
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# One copy of every upstream source tarball, shared by all build
+# workspaces. Sources are placed next to the PKGBUILD before makepkg runs,
+# which then finds them there instead of downloading them again.
+
+import os
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from . import Http
+from . import Cache
+from . import Workers
+
+# Upper bound of the cache size in bytes
+MAXSIZE = 4 * 1024 * 1024 * 1024
+
+# Settings of the HTTP client used for upstream downloads
+POOLSIZE = 4
+TIMEOUT = 60
+
+# Maximum number of sources downloaded at the same time
+WORKERS = POOLSIZE
+
+# ioctl cloning a file on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+class ChecksumError(Exception):
+    """Exception that is raised when a download does not match its checksum.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+
+
+def hasher(algorithm):
+    """Returns a hashlib object for a makepkg checksum array name.
+    :param algorithm: One of Srcinfo.CHECKSUMS.
+    """
+    if algorithm == 'b2':
+        return hashlib.blake2b()
+    return hashlib.new(algorithm)
+
+
+def fileDigest(path, algorithm):
+    """Returns the hex digest of a file.
+    """
+    h = hasher(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def materialize(source, destination):
+    """Make destination a copy of source without copying data if possible:
+    a hard link, else a reflink, else a plain copy.
+    """
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(src, dst)
+
+
+class SourceCache:
+    """Size-bounded, least recently used, on-disk cache of upstream sources,
+    keyed by URL and checksum.
+    """
+
+
+    def __init__(self, path=None, maxSize=MAXSIZE, client=None):
+        """Initialize a source cache.
+        :param path: Directory of the cache, CACHEDIR/sources if None.
+        :param maxSize: Size in bytes above which old entries are evicted.
+        :param client: Http.Client for downloads, a new one if None.
+        """
+        if path is None:
+            path = os.path.join(Cache.CACHEDIR, 'sources')
+        self.path = path
+        self.maxSize = maxSize
+        if client is None:
+            # Sources are verified byte for byte, never decode them
+            client = Http.Client(poolSize=POOLSIZE, timeout=TIMEOUT,
+                                 compress=False)
+        self.client = client
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytesDownloaded = 0
+
+
+    def filename(self, url, algorithm, checksum):
+        """Returns the file a source is cached in.
+        """
+        key = '\0'.join((url, algorithm, checksum.lower()))
+        return os.path.join(self.path,
+                            hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+
+    def lookup(self, url, algorithm, checksum):
+        """Returns the path of a cached source, or None.
+        """
+        path = self.filename(url, algorithm, checksum)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+
+    def insert(self, url, algorithm, checksum, token=None):
+        """Download a source into the cache.
+        Raises ChecksumError if it does not match checksum, in which case
+        nothing is stored.
+        :param token: Cancel.CancelToken aborting the download.
+        Returns the path of the cached file.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        os.close(fd)
+        try:
+            self.client.download(url, tmp, token=token)
+            digest = fileDigest(tmp, algorithm)
+            if digest != checksum.lower():
+                raise ChecksumError('%s: expected %s %s, got %s' %
+                                    (url, algorithm, checksum, digest))
+            os.chmod(tmp, 0o444)
+            path = self.filename(url, algorithm, checksum)
+            os.replace(tmp, path)
+        except:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        self.bytesDownloaded += os.path.getsize(path)
+        self.evict()
+        return path
+
+
+    def get(self, url, algorithm, checksum, token=None):
+        """Returns the path of a source, downloading it on a miss.
+        :param token: Cancel.CancelToken aborting the download.
+        """
+        path = self.lookup(url, algorithm, checksum)
+        if path is not None:
+            self.hits += 1
+            return path
+        self.misses += 1
+        return self.insert(url, algorithm, checksum, token)
+
+
+    def prepare(self, directory, sources, token=None):
+        """Place sources in a build directory, downloading the missing ones
+        in parallel.
+        :param directory: Build directory of a package.
+        :param sources: Output of Srcinfo.sources.
+        :param token: Cancel.CancelToken aborting the downloads.
+        Returns a list of Workers.Result, one per source. A source that
+        could not be fetched is left for makepkg to download itself.
+        """
+        def place(source):
+            filename, url, algorithm, checksum = source
+            destination = os.path.join(directory, filename)
+            if not os.path.exists(destination):
+                materialize(self.get(url, algorithm, checksum, token),
+                            destination)
+            return destination
+        return Workers.runAll(place, sources, WORKERS)
+
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits maxSize.
+        """
+        with self.lock:
+            files = []
+            total = 0
+            for name in os.listdir(self.path):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(self.path, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            if total <= self.maxSize:
+                return
+            files.sort()
+            for mtime, size, path in files:
+                if total <= self.maxSize:
+                    break
+                try:
+                    # Workspaces holding a hard link keep their copy
+                    os.unlink(path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+
+
+_sourceCache = None
+_sourceCacheLock = threading.Lock()
+
+def getSourceCache():
+    """Returns the shared SourceCache instance.
+    """
+    global _sourceCache
+    with _sourceCacheLock:
+        if _sourceCache is None:
+            _sourceCache = SourceCache()
+        return _sourceCache
+
+
+
+
+# vim: set ts=4 sw=4 noet:
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# Reads package metadata from .SRCINFO files so PKGBUILDs do not have to
+# be sourced by bash.
+
+import os
+import hashlib
+import threading
+import collections
+
+# Fields potluck needs from a package's metadata
+FIELDS = ['depends', 'makedepends', 'checkdepends', 'conflicts', 'provides',
+          'replaces']
+
+# Checksum arrays makepkg knows, strongest first
+CHECKSUMS = ['b2', 'sha512', 'sha384', 'sha256', 'sha224', 'sha1', 'md5']
+
+# Version control systems makepkg checks sources out of
+VCSPROTOCOLS = ['bzr', 'fossil', 'git', 'hg', 'svn']
+
+# Number of parsed files kept in memory
+CACHESIZE = 256
+
+_parsed = collections.OrderedDict()
+_parsedLock = threading.Lock()
+
+
+def currentArch():
+    """Returns the architecture packages are built for (makepkg's CARCH).
+    """
+    return os.uname().machine
+
+
+def parseSections(text):
+    """Split a .SRCINFO into its pkgbase and pkgname sections.
+    :param text: Contents of the .SRCINFO.
+    Returns (pkgbase fields, {pkgname: fields}), fields mapping each key to
+    its list of values.
+    """
+    base = {}
+    packages = collections.OrderedDict()
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        key, sep, value = line.partition('=')
+        if not sep:
+            continue
+        key = key.strip()
+        value = value.strip()
+        if key == 'pkgbase':
+            section = base
+        elif key == 'pkgname':
+            section = packages.setdefault(value, {})
+            continue
+        if section is None:
+            continue
+        section.setdefault(key, []).append(value)
+    return base, packages
+
+
+def parse(text):
+    """Parse a .SRCINFO, memoized by the hash of its contents.
+    :param text: Contents of the .SRCINFO.
+    """
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    with _parsedLock:
+        if key in _parsed:
+            _parsed.move_to_end(key)
+            return _parsed[key]
+    sections = parseSections(text)
+    with _parsedLock:
+        _parsed[key] = sections
+        if len(_parsed) > CACHESIZE:
+            _parsed.popitem(last=False)
+    return sections
+
+
+def metadata(text, pkgname=None, arch=None):
+    """Returns the dependency related fields of one package.
+    :param text: Contents of the .SRCINFO.
+    :param pkgname: Package of a split package, the first one if None.
+    :param arch: Architecture whose <field>_<arch> values are added,
+                 the current one if None.
+    Returns a dictionary mapping each name in FIELDS to a list.
+    """
+    if arch is None:
+        arch = currentArch()
+    base, packages = parse(text)
+    if pkgname not in packages:
+        pkgname = next(iter(packages), None)
+    overrides = packages.get(pkgname, {})
+
+    result = {}
+    result['pkgname'] = pkgname
+    for field in FIELDS:
+        values = []
+        for key in (field, field + '_' + arch):
+            # A key in a pkgname section replaces the pkgbase value
+            if key in overrides:
+                values += overrides[key]
+            else:
+                values += base.get(key, [])
+        result[field] = [v for v in values if v]
+    return result
+
+
+def sources(text, arch=None):
+    """Returns the downloadable sources of a package with their checksums.
+    :param text: Contents of the .SRCINFO.
+    :param arch: Architecture whose source_<arch> entries are added, the
+                 current one if None.
+    Returns a list of (filename, url, algorithm, checksum) tuples, using the
+    strongest checksum makepkg was given. VCS sources, local files and
+    sources whose checksum is SKIP are left out.
+    """
+    if arch is None:
+        arch = currentArch()
+    base, packages = parse(text)
+    result = []
+    for suffix in ('', '_' + arch):
+        entries = base.get('source' + suffix, [])
+        for algorithm in CHECKSUMS:
+            sums = base.get(algorithm + 'sums' + suffix)
+            if sums and len(sums) == len(entries):
+                break
+        else:
+            continue
+        for entry, checksum in zip(entries, sums):
+            filename, sep, url = entry.partition('::')
+            if not sep:
+                url = entry
+                filename = url.rstrip('/').rsplit('/', 1)[-1]
+            scheme = url.partition('://')[0]
+            if scheme not in ('http', 'https') or checksum == 'SKIP':
+                continue
+            result.append((filename, url, algorithm, checksum.lower()))
+    return result
+
+
+def hasVcsSources(text, arch=None):
+    """Returns True if a source of the package is checked out of version
+    control (git+https://..., svn://...), so that building the same
+    PKGBUILD again can give a different package.
+    :param text: Contents of the .SRCINFO.
+    :param arch: Architecture whose source_<arch> entries are checked, the
+                 current one if None.
+    """
+    if arch is None:
+        arch = currentArch()
+    base, packages = parse(text)
+    for entry in base.get('source', []) + base.get('source_' + arch, []):
+        url = entry.partition('::')[2] or entry
+        scheme, sep, rest = url.partition('://')
+        if sep and scheme.partition('+')[0] in VCSPROTOCOLS:
+            return True
+    return False
+
+
+
+
+# vim: set ts=4 sw=4 noet:
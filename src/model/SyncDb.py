@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# Reads pacman's sync databases (/var/lib/pacman/sync/*.db) directly so
+# package lookups do not have to fork a pacman process each.
+
+import os
+import re
+import tarfile
+import threading
+
+SYNCPATH = '/var/lib/pacman/sync'
+PACMANCONF = '/etc/pacman.conf'
+
+
+def parseDesc(text):
+    """Parse a desc (or depends) entry from a pacman database.
+    :param text: Contents of the entry.
+    Returns a dictionary mapping each %FIELD% to a list of its values.
+    """
+    fields = {}
+    key = None
+    for line in text.splitlines():
+        if line.startswith('%') and line.endswith('%') and len(line) > 2:
+            key = line[1:-1]
+            fields.setdefault(key, [])
+        elif line == '':
+            key = None
+        elif key is not None:
+            fields[key].append(line)
+    return fields
+
+
+def depName(dep):
+    """Strip the version constraint (and optdepends description) of a
+    dependency, e.g. 'glibc>=2.14' becomes 'glibc'.
+    :param dep: Dependency string.
+    """
+    return re.split('[<>=:]', dep, 1)[0].strip()
+
+
+def humanSize(size):
+    """Format a size in bytes the way pacman -Si does.
+    :param size: Size in bytes.
+    """
+    size = float(size)
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(size) < 1024.0 or unit == 'GiB':
+            break
+        size = size / 1024.0
+    return '%.2f %s' % (size, unit)
+
+
+def makeRecord(fields, repo):
+    """Turn parsed desc fields into the package dictionary used by potluck.
+    :param fields: Output of parseDesc.
+    :param repo: Name of the repository the package belongs to.
+    """
+    def first(key, default=''):
+        values = fields.get(key)
+        if values:
+            return values[0]
+        return default
+
+    d = {}
+    d['repo'] = repo
+    d['Name'] = first('NAME')
+    d['Version'] = first('VERSION')
+    d['Description'] = first('DESC')
+    d['dsize'] = humanSize(first('CSIZE', '0'))
+    d['csize'] = int(first('CSIZE', '0'))
+    d['isize'] = humanSize(first('ISIZE', '0'))
+    d['depends'] = list(fields.get('DEPENDS', []))
+    d['makedepends'] = list(fields.get('MAKEDEPENDS', []))
+    d['provides'] = list(fields.get('PROVIDES', []))
+    d['conflicts'] = list(fields.get('CONFLICTS', []))
+    d['replaces'] = list(fields.get('REPLACES', []))
+    return d
+
+
+def readDb(path, repo):
+    """Read every package of a sync database archive.
+    :param path: Path to the .db archive.
+    :param repo: Name of the repository.
+    Returns a list of package dictionaries sorted by name.
+    """
+    entries = {}
+    with tarfile.open(path, 'r:*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            pkgdir, sep, entry = member.name.rpartition('/')
+            if entry not in ('desc', 'depends'):
+                continue
+            data = archive.extractfile(member).read().decode('utf-8', 'replace')
+            fields = entries.setdefault(pkgdir, {})
+            fields.update(parseDesc(data))
+
+    packages = []
+    for fields in entries.values():
+        if fields.get('NAME'):
+            packages.append(makeRecord(fields, repo))
+    packages.sort(key=lambda d: d['Name'])
+    return packages
+
+
+def getRepos(path=SYNCPATH, conf=PACMANCONF):
+    """Returns the configured repositories in priority order.
+    :param path: Directory holding the sync databases.
+    :param conf: pacman configuration file used for repository order.
+    """
+    repos = []
+    try:
+        with open(conf, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('[') and line.endswith(']'):
+                    section = line[1:-1].strip()
+                    if section != 'options' and section not in repos:
+                        repos.append(section)
+    except (IOError, OSError):
+        pass
+    if not repos:
+        try:
+            names = os.listdir(path)
+        except OSError:
+            names = []
+        repos = sorted(n[:-3] for n in names if n.endswith('.db'))
+    return repos
+
+
+class SyncDb:
+    """An in memory copy of pacman's sync databases.
+    Databases are re-read whenever one of the archives changes on disk.
+    """
+
+
+    def __init__(self, path=SYNCPATH, repos=None):
+        """Initialize a sync database reader.
+        :param path: Directory holding <repo>.db archives.
+        :param repos: Repositories in priority order, read from
+                      pacman.conf when not given.
+        """
+        self.path = path
+        self.repos = repos
+        self.packages = {}
+        self.ordered = []
+        self.providers = {}
+        self.complete = False
+        self.stamps = None
+        self.lock = threading.Lock()
+
+
+    def dbFiles(self):
+        """Returns (repo, path) pairs for every configured database.
+        """
+        repos = self.repos
+        if repos is None:
+            repos = getRepos(self.path)
+        return [(r, os.path.join(self.path, r + '.db')) for r in repos]
+
+
+    def currentStamps(self):
+        """Returns the modification times of the database archives.
+        """
+        stamps = []
+        for repo, path in self.dbFiles():
+            try:
+                stamps.append((path, os.stat(path).st_mtime_ns))
+            except OSError:
+                stamps.append((path, None))
+        return stamps
+
+
+    def load(self):
+        """(Re)read the databases if any of them changed since the last read.
+        """
+        with self.lock:
+            stamps = self.currentStamps()
+            if stamps == self.stamps:
+                return
+            packages = {}
+            ordered = []
+            providers = {}
+            complete = len(stamps) > 0
+            for repo, path in self.dbFiles():
+                try:
+                    records = readDb(path, repo)
+                except (IOError, OSError, tarfile.TarError, EOFError):
+                    # Missing or unreadable (e.g. zstd compressed) database
+                    complete = False
+                    continue
+                for d in records:
+                    ordered.append(d)
+                    if d['Name'] not in packages:
+                        packages[d['Name']] = d
+                    for p in d['provides']:
+                        providers.setdefault(depName(p), d)
+            self.packages = packages
+            self.ordered = ordered
+            self.providers = providers
+            self.complete = complete
+            self.stamps = stamps
+
+
+    def available(self):
+        """Returns True if every configured database could be read.
+        """
+        self.load()
+        return self.complete
+
+
+    def getPkgInfo(self, name):
+        """Get information about a given package.
+        :param name: Name of the package.
+        Returns None if the package is in none of the databases.
+        """
+        self.load()
+        d = self.packages.get(name)
+        if d is None:
+            return None
+        return dict(d)
+
+
+    def findProvider(self, name):
+        """Get the package that is or provides name, like pacman -S name.
+        :param name: Package name, without version constraint.
+        Returns None if no repository satisfies name.
+        """
+        self.load()
+        d = self.packages.get(name) or self.providers.get(name)
+        if d is None:
+            return None
+        return dict(d)
+
+
+    def search(self, term):
+        """Search package names, descriptions and provides like pacman -Ss.
+        :param term: Regular expression to search for.
+        """
+        self.load()
+        try:
+            match = re.compile(term, re.IGNORECASE).search
+        except re.error:
+            # pacman falls back to a plain substring search
+            lowered = term.lower()
+            match = lambda s: lowered in s.lower()
+
+        result = []
+        seen = set()
+        for d in self.ordered:
+            if d['Name'] in seen:
+                continue
+            if match(d['Name']) or match(d['Description']) or \
+               any(match(p) for p in d['provides']):
+                seen.add(d['Name'])
+                result.append(dict(self.packages[d['Name']]))
+        return result
+
+
+    def __contains__(self, name):
+        self.load()
+        return name in self.packages
+
+
+
+
+_syncDb = None
+_syncDbLock = threading.Lock()
+
+def getSyncDb():
+    """Returns the shared SyncDb instance.
+    """
+    global _syncDb
+    with _syncDbLock:
+        if _syncDb is None:
+            _syncDb = SyncDb()
+        return _syncDb
+
+
+
+
+# vim: set ts=4 sw=4 noet:
@@ -26,15 +26,86 @@ from PyQt4.QtGui import *
 
 from . import Aur
 from . import Pacman
+from . import Workers
+from . import Resolver
+from . import Builder
+from . import Progress
+from . import Cancel
+
+
+def aurSearch(term, token=None):
+    """Returns the AUR search results for term.
+    :param token: Cancel.CancelToken aborting the request.
+    """
+    return Aur.Query(term, token).query
+
+
+# Steps of a commit, in the order they run
+REMOVE = 'remove'
+REPO = 'repo'
+AURDEPENDS = 'aurdepends'
+AUR = 'aur'
+
+STEPLABELS = {
+    REMOVE: 'Removing ',
+    REPO: 'Installing ',
+    AURDEPENDS: 'Installing dependencies ',
+    AUR: 'Building ',
+}
+
+
+class CommitPlan:
+    """The pacman and makepkg runs a set of changes turns into.
+    """
+
+
+    def __init__(self):
+        """Initialize an empty plan.
+        """
+        self.removes = []
+        # Repository packages to install or upgrade
+        self.repo = []
+        # AUR packages to install or upgrade
+        self.aur = []
+        # Resolver.Plan of the AUR packages and their dependencies
+        self.aurPlan = None
+
+
+    def steps(self):
+        """Returns the (phase, names) steps of the commit, empty ones left
+        out. Removes run first so that they can make way for packages that
+        conflict with them, AUR packages last since they may depend on
+        anything installed before.
+        """
+        steps = [(REMOVE, self.removes), (REPO, self.repo)]
+        if self.aurPlan is not None:
+            depends = [d for d in self.aurPlan.repoDepends if d not in self.repo]
+            steps.append((AURDEPENDS, depends))
+            steps.append((AUR, list(self.aurPlan.order)))
+        return [(phase, names) for phase, names in steps if names]
+
+
+    def __len__(self):
+        """Returns the number of packages the plan touches.
+        """
+        return sum(len(names) for phase, names in self.steps())
+
+
+
 
 class Transaction:
     """An abstraction for interacting with the packaging system.
     """
 
 
-    def __init__(self):
+    def __init__(self, token=None):
         """Initialize a new Transaction.
+        :param token: Cancel.CancelToken the transaction's subprocesses and
+                      requests are aborted with, a new one if None.
         """
+        if token is None:
+            token = Cancel.CancelToken()
+        self.token = token
         self.queryResult = []
         self.repoUpgrades = {}
         self.aurUpgrades = {}
@@ -43,16 +114,30 @@ class Transaction:
         self.removes = {}
         self.aurDepends = {}
         self.aurBuildDepends = {}
+        self.errors = []
+        # Names of the changed packages the last commit did not carry out
+        self.failed = set()
+        # Builder states of the last AUR build, by package
+        self.aurStates = {}
+        # Builder.Timings of the last AUR upgrade
+        self.timings = None
         
 
+    def cancel(self):
+        """Abort whatever the transaction is running, from any thread. The
+        running call raises Cancel.CancelledError shortly after.
+        """
+        self.token.cancel()
+
+
     def sync(self):
         """Sync local databases with network mirror.
         """
-        Pacman.sync()
+        Pacman.sync(self.token)
 
 
     def getInstalled(self):
-        """Returns a list of installed packages.
+        """Returns the set of installed packages.
         """
         return Pacman.getInstalled()
 
@@ -60,11 +145,20 @@ class Transaction:
     def toBeUpgraded(self):
         """Returns list of packages in need of upgrading.
         """
-        pacUpgrade =  Pacman.toBeUpgraded()
-        aurUpgrade = Aur.outOfDate()
-        for app in aurUpgrade:
-            pacUpgrade.append(app)
-        return pacUpgrade
+        # The repo and AUR checks are independent, run them side by side
+        aurErrors = []
+        pacResult, aurResult = Workers.runAll(
+            lambda check: check(self.token),
+            [Pacman.toBeUpgraded,
+             lambda token: Aur.outOfDate(token, aurErrors)])
+        result = []
+        self.errors += [r.error for r in aurErrors]
+        for r in (pacResult, aurResult):
+            if not r.ok():
+                self.errors.append(r.error)
+                continue
+            result += r.value
+        return result
 
 
     def changeList(self, installList, upgradeList, removeList):
@@ -74,23 +168,27 @@ class Transaction:
         :param removeList: List of files to remove.
         """
         installed = self.getInstalled()
+        repoNames = [app['Name'] for app in list(installList.values()) +
+                     list(upgradeList.values()) if app['repo'] != 'aur']
+        repoNames += [app['Name'] for app in list(removeList.values())]
+        repoInfo = Pacman.getPkgInfoMany(repoNames, self.token)
+        aurNames = [app['Name'] for app in list(installList.values()) +
+                    list(upgradeList.values()) if app['repo'] == 'aur']
+        aurErrors = []
+        aurInfo = Aur.getPkgInfoMany(aurNames, self.token, aurErrors)
+        self.errors += [r.error for r in aurErrors]
         for app in  list(installList.values()):
             if app['repo'] == 'aur':
-                tInfo = Aur.getPkgInfo(app['Name'])
-                self.aurInstalls[app['Name']] = app
+                self.aurInstalls[app['Name']] = aurInfo.get(app['Name'], app)
             else:
-                tInfo = Pacman.getPkgInfo(app['Name'])
-                self.repoInstalls[app['Name']] = tInfo
+                self.repoInstalls[app['Name']] = repoInfo.get(app['Name'])
         for app in  list(upgradeList.values()):
             if app['repo'] == 'aur':
-                tInfo = Aur.getPkgInfo(app['Name'])
-                self.aurUpgrades[app['Name']] = app
+                self.aurUpgrades[app['Name']] = aurInfo.get(app['Name'], app)
             else:
-                tInfo = Pacman.getPkgInfo(app['Name'])
-                self.repoUpgrades[app['Name']] = tInfo
+                self.repoUpgrades[app['Name']] = repoInfo.get(app['Name'])
         for app in  list(removeList.values()):
-            tInfo = Pacman.getPkgInfo(app['Name'])
-            self.removes[app['Name']] = tInfo
+            self.removes[app['Name']] = repoInfo.get(app['Name'])
 
         rDict = {}
         rDict['repoInstalls'] = self.repoInstalls
@@ -104,73 +202,212 @@ class Transaction:
         return rDict
         
 
+    def planCommit(self, installList, upgradeList, removeList):
+        """Turn a set of changes into a CommitPlan. AUR packages are
+        resolved here, so this needs the network.
+        :param installList: Dictionary of applications to install.
+        :param upgradeList: Dictionary of applications to upgrade.
+        :param removeList: Dictionary of applications to remove.
+        """
+        self.timings = Builder.Timings()
+        plan = CommitPlan()
+        plan.removes = sorted(removeList)
+        for app in list(upgradeList.values()) + list(installList.values()):
+            if not isinstance(app, dict):
+                continue
+            if app['repo'] == 'aur':
+                names = plan.aur
+            else:
+                names = plan.repo
+            if app['Name'] not in names:
+                names.append(app['Name'])
+        if plan.aur:
+            with self.timings.measure('resolve'):
+                plan.aurPlan = Resolver.Resolver(self.token).resolve(plan.aur)
+        return plan
+
+
+    def commit(self, plan, progress=None):
+        """Carry out a CommitPlan: one pacman -R for all removes, one
+        pacman -S for all repository installs and upgrades, then the AUR
+        packages, their repository dependencies first.
+        :param plan: CommitPlan from planCommit.
+        :param progress: Called with a Progress.Event at the start of each
+                         step and for every progress line of pacman or
+                         build started. Events count packages over the
+                         whole plan.
+        Returns the list of errors; they are added to self.errors too, and
+        the packages whose changes were not made to self.failed.
+        A failing step does not stop the ones that do not depend on it, a
+        cancel stops all of them.
+        """
+        if self.timings is None:
+            self.timings = Builder.Timings()
+        total = len(plan)
+        done = 0
+        errors = []
+        failed = set()
+        try:
+            for phase, names in plan.steps():
+                if self.token.cancelled():
+                    if not errors or \
+                       not isinstance(errors[-1][1], Cancel.CancelledError):
+                        errors.append((phase, Cancel.CancelledError()))
+                    failed |= self.stepFailures(plan, phase, names)
+                    continue
+                relay = None
+                if progress is not None:
+                    relay = self.relayProgress(progress, done, len(names), total)
+                    relay(Progress.Event(Progress.PREPARE, current=0,
+                                         message=STEPLABELS[phase] +
+                                         ', '.join(names)))
+                try:
+                    if phase == AUR:
+                        if errors and errors[-1][0] == AURDEPENDS:
+                            raise Pacman.PackageError('Dependencies failed to install')
+                        self.buildAur(plan.aurPlan, relay)
+                        continue
+                    with self.timings.measure(phase):
+                        if phase == REMOVE:
+                            Pacman.removeMany(names, progress=relay,
+                                              token=self.token)
+                        elif phase == REPO:
+                            Pacman.installMany(names, progress=relay,
+                                               token=self.token)
+                        elif phase == AURDEPENDS:
+                            Pacman.installMany(names, asDeps=True,
+                                               progress=relay,
+                                               token=self.token)
+                except Exception as e:
+                    errors.append((phase, e))
+                    failed |= self.stepFailures(plan, phase, names)
+                finally:
+                    done += len(names)
+        finally:
+            if plan.aurPlan is not None:
+                for upgrade in plan.aurPlan.upgrades.values():
+                    upgrade.cleanup()
+        if progress is not None:
+            progress(Progress.Event(Progress.INSTALL, current=total,
+                                    total=total, message='Done'))
+        self.errors += [e for phase, e in errors]
+        self.failed |= failed
+        return [e for phase, e in errors]
+
+
+    def stepFailures(self, plan, phase, names):
+        """Returns the changed packages a failed step leaves undone.
+        :param plan: CommitPlan the step belongs to.
+        :param phase: Step that failed.
+        :param names: Packages of the step.
+        """
+        if phase == AURDEPENDS:
+            # The AUR packages needing these are not built
+            return set(plan.aur)
+        if phase == AUR:
+            return set(n for n in plan.aur
+                       if self.aurStates.get(n) != Builder.BUILT)
+        return set(names)
+
+
+    def relayProgress(self, progress, offset, count, total):
+        """Returns a callback passing a step's events on to progress, with
+        the step's package counts turned into counts over the whole commit.
+        :param offset: Packages of the steps before.
+        :param count: Packages of this step.
+        :param total: Packages of the whole commit.
+        """
+        def relay(event):
+            # pacman counts the dependencies it pulls in as well, scale its
+            # n of m to the step's share of the commit
+            if event.total:
+                event.current = offset + event.current * count // event.total
+            else:
+                event.current = offset
+            event.total = total
+            progress(event)
+        return relay
+
+
+    def buildAur(self, plan, progress=None):
+        """Build and install the AUR packages of a Resolver.Plan.
+        """
+        if plan.missing:
+            raise Pacman.PackageError('Unresolvable dependencies: ' +
+                                      ', '.join(sorted(plan.missing)))
+        states = Builder.Scheduler(plan, timings=self.timings,
+                                   progress=progress, token=self.token).run()
+        self.aurStates = states
+        self.token.check()
+        failed = [n for n in plan.order if states.get(n) != Builder.BUILT]
+        if failed:
+            raise Pacman.PackageError('Building failed: ' + ', '.join(failed))
+
+
     def upgrade(self, app):
         """Upgrade a given application.
         :param app: Application to upgrade.
         """
         if not isinstance(app, dict):
             return
-        installedList = Pacman.getInstalled()
         if app['repo'] == "aur":
-            upgrade = Aur.Upgrade(app['Name'])
-            for bDep in upgrade.buildDepends:
-                if bDep not in installedList:
-                    recTransaction = Transaction()
-                    r = Pacman.getPkgInfo(bDep)
-                    if r == None:
-                        r = Aur.getPkgInfo(bDep)
-                    recTransaction.upgrade(r)
-            for dep in upgrade.depends:
-                if dep not in installedList:
-                    recTransaction = Transaction()
-                    r = Pacman.getPkgInfo(bDep)
-                    if r == None:
-                        r = Aur.getPkgInfo(bDep)
-                    recTransaction.upgrade(r)
-            if upgrade.makePkg() != 0:
-                raise PackageError('makepkg failed')
-            Pacman.installLocal(app['Name'])
+            plan = self.planCommit({}, {app['Name']: app}, {})
+            errors = self.commit(plan)
+            if errors:
+                raise errors[0]
         else:
             try:
                 Pacman.install(app['Name'])
             except:
                 pass
-        
+
 
 
     def query(self, term):
         """Search for applications whose name and description contain <term>.
         :param term: Term to match against.
         """
-        result = []
+        self.streamQuery(term, None)
+
+
+    def streamQuery(self, term, callback):
+        """Search like query, handing out each backend's results as soon as
+        that backend answers, so the repositories do not wait for the AUR.
+        :param term: Term to match against.
+        :param callback: Called with the list of results of each backend,
+                         from the thread that ran it; may be None.
+        All results are in self.queryResult afterwards.
+        """
         installedList = Pacman.getInstalled()
 
-        pDict = Pacman.search(term)
-        for app in pDict:
-            item = app
-            if 'Name' not in item:
-                continue
-            if item['Name'] in installedList:
-                item['Installed'] = True
-            else:
-                item['Installed'] = False
-            result.append(app)
-
-        aurQuery = Aur.Query(term)
-        aurList = aurQuery.query
-
-        if isinstance(aurList, list):
-            for app in aurList:
-                item = app
-                item['repo'] = 'aur'
-                if item['Name'] in installedList:
-                    item['Installed'] = True
-                else:
-                    item['Installed'] = False
-                result.append(app)
+        def search(backend):
+            func, repo = backend
+            batch = []
+            apps = func(term, self.token)
+            if not isinstance(apps, list):
+                return batch
+            for app in apps:
+                if not isinstance(app, dict) or 'Name' not in app:
+                    continue
+                if repo is not None:
+                    app['repo'] = repo
+                app['Installed'] = app['Name'] in installedList
+                batch.append(app)
+            if callback is not None and not self.token.cancelled():
+                callback(batch)
+            return batch
 
+        # Search the repos and the AUR at the same time. If one of them
+        # fails the results of the other are still shown.
+        result = []
+        for r in Workers.runAll(search, [(Pacman.search, None),
+                                         (aurSearch, 'aur')]):
+            if r.ok():
+                result += r.value
+            else:
+                self.errors.append(r.error)
         self.queryResult = result
-        
+
 
 
     def remove(self, app):
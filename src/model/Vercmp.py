@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# Version comparison following pacman's vercmp (alpm_pkg_vercmp and
+# rpmvercmp from libalpm), so versions can be compared without forking.
+
+import sys
+import functools
+
+DIGITS = frozenset('0123456789')
+ALPHA = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+ALNUM = DIGITS | ALPHA
+
+# Character classes used by the final comparison of rpmvercmp
+EMPTY = 0
+LETTER = 1
+OTHER = 2
+
+
+def charClass(c):
+    if c == '':
+        return EMPTY
+    if c in ALPHA:
+        return LETTER
+    return OTHER
+
+
+@functools.lru_cache(maxsize=4096)
+def tokenize(version):
+    """Split a version string into the segments rpmvercmp walks over.
+    :param version: Version (or epoch, or release) string.
+    Returns (segments, trailing) where segments is a tuple of
+    (separatorLength, segment, isNumber, firstChar) and trailing is the
+    number of separator characters after the last segment.
+    """
+    segments = []
+    i = 0
+    n = len(version)
+    while i < n:
+        start = i
+        while i < n and version[i] not in ALNUM:
+            i += 1
+        if i == n:
+            return tuple(segments), i - start
+        sep = i - start
+        first = version[start]
+        segStart = i
+        isNumber = version[i] in DIGITS
+        kind = DIGITS if isNumber else ALPHA
+        while i < n and version[i] in kind:
+            i += 1
+        segments.append((sep, version[segStart:i], isNumber, first))
+    return tuple(segments), 0
+
+
+def compareTokens(tok1, tok2):
+    """rpmvercmp over two tokenized strings.
+    """
+    segs1, trail1 = tok1
+    segs2, trail2 = tok2
+    len1 = len(segs1)
+    len2 = len(segs2)
+    i = 0
+    while True:
+        # Position of each pointer at the top of the loop
+        rest1 = i < len1 or trail1 > 0
+        rest2 = i < len2 or trail2 > 0
+        if not (rest1 and rest2):
+            c1 = charClass(segs1[i][3]) if i < len1 else \
+                (OTHER if trail1 else EMPTY)
+            c2 = charClass(segs2[i][3]) if i < len2 else \
+                (OTHER if trail2 else EMPTY)
+            break
+        # Both pointers skip their separators
+        if i >= len1 or i >= len2:
+            c1 = charClass(segs1[i][1][0]) if i < len1 else EMPTY
+            c2 = charClass(segs2[i][1][0]) if i < len2 else EMPTY
+            break
+        sep1, seg1, num1, first1 = segs1[i]
+        sep2, seg2, num2, first2 = segs2[i]
+        if sep1 != sep2:
+            return -1 if sep1 < sep2 else 1
+        if num1 != num2:
+            # A numeric segment is always newer than an alpha one
+            return 1 if num1 else -1
+        if num1:
+            seg1 = seg1.lstrip('0')
+            seg2 = seg2.lstrip('0')
+            if len(seg1) != len(seg2):
+                return 1 if len(seg1) > len(seg2) else -1
+        if seg1 != seg2:
+            return -1 if seg1 < seg2 else 1
+        i += 1
+
+    if c1 == EMPTY and c2 == EMPTY:
+        return 0
+    # A remaining alpha string never beats an empty string
+    if (c1 == EMPTY and c2 != LETTER) or c1 == LETTER:
+        return -1
+    return 1
+
+
+def rpmvercmp(a, b):
+    """Compare two version segments like libalpm's rpmvercmp.
+    """
+    if a == b:
+        return 0
+    return compareTokens(tokenize(a), tokenize(b))
+
+
+@functools.lru_cache(maxsize=4096)
+def parseEVR(evr):
+    """Split [epoch:]version[-release] into its tokenized parts.
+    :param evr: Full version string.
+    Returns (epoch, version, release) with release None when absent.
+    """
+    s = 0
+    while s < len(evr) and evr[s] in DIGITS:
+        s += 1
+    if s < len(evr) and evr[s] == ':':
+        epoch = evr[:s] or '0'
+        rest = evr[s + 1:]
+    else:
+        epoch = '0'
+        rest = evr
+    # The release is everything after the last '-' following the epoch
+    version, sep, release = rest.rpartition('-')
+    if not sep:
+        version = rest
+        release = None
+    if release is None:
+        return tokenize(epoch), tokenize(version), None
+    return tokenize(epoch), tokenize(version), tokenize(release)
+
+
+def compareEVR(evr1, evr2):
+    """Compare two parsed versions.
+    """
+    epoch1, ver1, rel1 = evr1
+    epoch2, ver2, rel2 = evr2
+    ret = compareTokens(epoch1, epoch2)
+    if ret == 0:
+        ret = compareTokens(ver1, ver2)
+        if ret == 0 and rel1 is not None and rel2 is not None:
+            ret = compareTokens(rel1, rel2)
+    return ret
+
+
+@functools.lru_cache(maxsize=8192)
+def vercmp(a, b):
+    """Compare two package versions.
+    :param a: First version.
+    :param b: Second version.
+    Returns -1, 0 or 1 when a is older than, equal to or newer than b,
+    exactly like pacman's vercmp.
+    """
+    if a is None and b is None:
+        return 0
+    if a is None:
+        return -1
+    if b is None:
+        return 1
+    if a == b:
+        return 0
+    return compareEVR(parseEVR(a), parseEVR(b))
+
+
+def vercmpMany(pairs):
+    """Compare many pairs of versions at once.
+    :param pairs: Iterable of (a, b) version pairs.
+    Returns a list with the vercmp result of every pair, in order.
+    Each distinct version string is only parsed once.
+    """
+    pairs = list(pairs)
+    parsed = {}
+    for pair in pairs:
+        for v in pair:
+            if v is not None and v not in parsed:
+                parsed[v] = parseEVR(v)
+
+    result = []
+    for a, b in pairs:
+        if a is None or b is None or a == b:
+            result.append(vercmp(a, b))
+        else:
+            result.append(compareEVR(parsed[a], parsed[b]))
+    return result
+
+
+
+
+# Cases from pacman's own vercmp test suite
+CONFORMANCE = [
+    ('1.5.0', '1.5.0', 0),
+    ('1.5.1', '1.5.0', 1),
+    ('1.5.1', '1.5', 1),
+    ('1.5.0-1', '1.5.0-1', 0),
+    ('1.5.0-1', '1.5.0-2', -1),
+    ('1.5.0-1', '1.5.1-1', -1),
+    ('1.5.0-2', '1.5.1-1', -1),
+    ('1.5-1', '1.5.1-1', -1),
+    ('1.5-2', '1.5.1-1', -1),
+    ('1.5-2', '1.5.1-2', -1),
+    ('1.5', '1.5-1', 0),
+    ('1.5-1', '1.5', 0),
+    ('1.1-1', '1.1', 0),
+    ('1.0-1', '1.1', -1),
+    ('1.1-1', '1.0', 1),
+    ('1.5b-1', '1.5-1', -1),
+    ('1.5b', '1.5', -1),
+    ('1.5b-1', '1.5', -1),
+    ('1.5b', '1.5.1', -1),
+    ('1.0a', '1.0alpha', -1),
+    ('1.0alpha', '1.0b', -1),
+    ('1.0b', '1.0beta', -1),
+    ('1.0beta', '1.0rc', -1),
+    ('1.0rc', '1.0', -1),
+    ('1.5.a', '1.5', 1),
+    ('1.5.b', '1.5.a', 1),
+    ('1.5.1', '1.5.b', 1),
+    ('1.5.b-1', '1.5.b', 0),
+    ('1.5-1', '1.5.b', -1),
+    ('2.0', '2_0', 0),
+    ('2.0_a', '2_0.a', 0),
+    ('2.0a', '2.0.a', -1),
+    ('2___a', '2_a', 1),
+    ('0:1.0', '0:1.0', 0),
+    ('0:1.0', '0:1.1', -1),
+    ('1:1.0', '0:1.0', 1),
+    ('1:1.0', '0:1.1', 1),
+    ('1:1.0', '2:1.1', -1),
+    ('1:1.0', '0:1.0-1', 1),
+    ('1:1.0-1', '0:1.1-1', 1),
+    ('0:1.0', '1.0', 0),
+    ('0:1.0', '1.1', -1),
+    ('0:1.1', '1.0', 1),
+    ('1:1.0', '1.0', 1),
+    ('1:1.0', '1.1', 1),
+    ('1:1.1', '1.1', 1),
+]
+
+
+# This is for unit testing
+if (__name__ == "__main__"):
+
+    if (len(sys.argv) == 3):
+        print(vercmp(sys.argv[1], sys.argv[2]))
+        sys.exit()
+
+    failures = 0
+    cases = CONFORMANCE + [(b, a, -r) for a, b, r in CONFORMANCE]
+    batch = vercmpMany((a, b) for a, b, r in cases)
+    for (a, b, expected), got in zip(cases, batch):
+        single = vercmp(a, b)
+        if single != expected or got != expected:
+            print('FAIL: %s %s: expected %d, got %d/%d' %
+                  (a, b, expected, single, got))
+            failures += 1
+    print('%d of %d cases passed' % (len(cases) - failures, len(cases)))
+    sys.exit(1 if failures else 0)
+
+
+
+
+# vim: set ts=4 sw=4 noet:
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# Runs independent, mostly network bound, tasks on a bounded thread pool.
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Default number of tasks run at the same time
+LIMIT = 8
+
+
+class Result:
+    """The outcome of one task.
+    """
+
+
+    def __init__(self, item, value=None, error=None):
+        """Initialize a result.
+        :param item: The argument the task was run with.
+        :param value: What the task returned.
+        :param error: The exception the task raised, if any.
+        """
+        self.item = item
+        self.value = value
+        self.error = error
+
+
+    def ok(self):
+        """Returns True if the task did not raise.
+        """
+        return self.error is None
+
+
+    def get(self):
+        """Returns the value of the task, re-raising its error if it failed.
+        """
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+
+
+def runOne(func, item):
+    """Run a task, capturing its exception instead of raising it.
+    """
+    try:
+        return Result(item, func(item))
+    except Exception as e:
+        return Result(item, error=e)
+
+
+def runAll(func, items, limit=None):
+    """Run func(item) for every item, at most limit at a time.
+    :param func: Function to call.
+    :param items: Arguments, one per task.
+    :param limit: Maximum number of concurrent tasks, LIMIT if None.
+    Returns a list of Result objects in the order of items. A failing task
+    is reported in its Result and does not stop the others.
+    """
+    items = list(items)
+    if limit is None:
+        limit = LIMIT
+    limit = max(1, min(limit, len(items)))
+    if len(items) <= 1 or limit == 1:
+        return [runOne(func, item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=limit) as executor:
+        futures = [executor.submit(runOne, func, item) for item in items]
+        return [f.result() for f in futures]
+
+
+
+
+# vim: set ts=4 sw=4 noet:
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Potluck
+#
+# Private build directories for AUR packages, so downloads and builds never
+# depend on (or change) the process working directory.
+
+import os
+import shutil
+import tempfile
+import weakref
+
+# Directory the workspaces are created in. $POTLUCK_BUILDDIR overrides the
+# system temporary directory, e.g. to build on a tmpfs or a bigger disk.
+ROOT = os.environ.get('POTLUCK_BUILDDIR') or tempfile.gettempdir()
+
+
+class Workspace:
+    """A uniquely named directory holding one package's build files.
+    It is removed by cleanup(), when leaving a with block, or at the latest
+    when the object is garbage collected or the program exits.
+    """
+
+
+    def __init__(self, name, root=None):
+        """Create a workspace.
+        :param name: Package the workspace is for, used as name prefix.
+        :param root: Directory to create it in, ROOT if None.
+        """
+        if root is None:
+            root = ROOT
+        os.makedirs(root, exist_ok=True)
+        self.name = name
+        self.path = tempfile.mkdtemp(prefix='potluck-' + name + '-', dir=root)
+        self.finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+
+
+    def join(self, *parts):
+        """Returns the path of a file inside the workspace.
+        """
+        return os.path.join(self.path, *parts)
+
+
+    def cleanup(self):
+        """Remove the workspace and everything in it.
+        """
+        self.finalizer()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.cleanup()
+
+
+
+
+# vim: set ts=4 sw=4 noet:
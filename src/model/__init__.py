@@ -19,7 +19,10 @@
 
 # This file is needed by python to properly create te aur module.
 
-__all__ = ["Transaction", "Aur", "Pacman"]
+__all__ = ["Transaction", "Aur", "Pacman", "SyncDb", "LocalDb", "Vercmp",
+           "Http", "Workers", "Cache", "AurMirror", "Srcinfo", "BashPool",
+           "Resolver", "Builder", "Workspace", "PackageCache", "SourceCache",
+           "Progress", "Cancel"]
 
 
 
@@ -1,4 +0,0 @@
-#!/usr/bin/env bash
-
-. ./PKGBUILD
-echo ${conflicts[*]}
@@ -0,0 +1,32 @@
+#!/usr/bin/env bash
+
+# Long-lived PKGBUILD evaluator used by BashPool.py.
+#
+# Reads NUL terminated package directories on stdin. For each one the
+# PKGBUILD is sourced in a subshell and a record is written to stdout as
+# NUL terminated strings: a status (0 on success), then for every field
+# its name, the number of values and the values themselves. Architecture
+# specific arrays (e.g. depends_x86_64) are appended to the generic ones.
+# A lone \001 ends every record, even if the subshell died.
+
+CARCH=${CARCH:-$(uname -m)}
+FIELDS=(depends makedepends checkdepends conflicts provides replaces)
+
+while IFS= read -r -d '' dir; do
+    (
+        cd "$dir" 2>/dev/null || { printf '1\0'; exit; }
+        . ./PKGBUILD >/dev/null 2>&1 || { printf '1\0'; exit; }
+        set -f
+        printf '0\0'
+        for field in "${FIELDS[@]}"; do
+            generic="${field}[@]"
+            specific="${field}_${CARCH}[@]"
+            values=("${!generic}" "${!specific}")
+            printf '%s\0%d\0' "$field" "${#values[@]}"
+            if (( ${#values[@]} )); then
+                printf '%s\0' "${values[@]}"
+            fi
+        done
+    ) </dev/null
+    printf '\001\0'
+done
@@ -23,25 +23,7 @@
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
 
-
-class searchDialog(QProgressDialog):
-    """Dialog shown while searching.
-    """
-    def __init__(self, parent):
-        QProgressDialog.__init__(self, parent)
-        #QProgressDialog(QString("Searching..."), QString("Cancel"), 0, 0, self)
-        searchString = str('Searching...')
-        searchLabel = QLabel(searchString)
-        self.setLabel(searchLabel)
-        self.setWindowModality(Qt.WindowModal)
-        self.setAutoReset(True)
-        self.setAutoClose(True)
-        self.setMinimum(0)
-        self.setMaximum(0)
-        self.resize(220,120)
-        self.setWindowTitle("Searching...")
-
-
+from model.SyncDb import humanSize
 
 
 class syncDialog(QProgressDialog):
@@ -66,18 +48,33 @@ class commitDialog(QProgressDialog):
     """
     def __init__(self, parent):
         QProgressDialog.__init__(self, parent)
-        statusString = str('Preparing Changes')
-        statusLabel = QLabel(statusString)
-        self.setLabel(statusLabel)
+        self.setLabelText(str('Preparing Changes'))
         self.setWindowModality(Qt.WindowModal)
-        self.setAutoReset(True)
-        self.setAutoClose(True)
+        self.setAutoReset(False)
+        self.setAutoClose(False)
+        self.setCancelButton(None)
         self.setMinimum(0)
         self.setMaximum(0)
-        self.resize(220,120)
+        self.resize(320,120)
         self.setWindowTitle("Commiting Changes")
 
 
+    def showProgress(self, event):
+        """Show a Progress.Event: package N of M in the bar, the current
+        phase and downloaded bytes in the label.
+        """
+        if event.total:
+            self.setMaximum(event.total)
+            self.setValue(event.current)
+            text = '%s (%d of %d)' % (event.message, event.current, event.total)
+        else:
+            text = event.message
+        if event.bytesTotal and event.phase == 'download':
+            text += '\n%s of %s downloaded' % (humanSize(event.bytesDone),
+                                               humanSize(event.bytesTotal))
+        self.setLabelText(text)
+
+
 
 
 class notRoot(QMessageBox):
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2011 Thomas Schreiber
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# potluck
+# by Thomas Schreiber <ubiquill@gmail.com>
+#
+# The item model behind the package list. Rows are kept in a plain array;
+# the view asks for the cells it actually shows.
+
+from PyQt4.QtGui import *
+from PyQt4.QtCore import *
+
+# Columns of the package list
+CHECK = 0
+REPO = 1
+NAME = 2
+DESCRIPTION = 3
+
+HEADERS = ['Installed', 'Repo', 'Name', 'Description']
+
+
+class PackageRow(object):
+    """One package of the list.
+    """
+    __slots__ = ('repo', 'name', 'description', 'checked', 'changed')
+
+    def __init__(self, repo, name, description, checked, changed=False):
+        self.repo = repo
+        self.name = name
+        self.description = description
+        self.checked = checked
+        self.changed = changed
+
+    def key(self, column):
+        """Returns the value the row is sorted by in a column.
+        """
+        if column == CHECK:
+            return (not self.checked, self.name)
+        if column == REPO:
+            return (self.repo, self.name)
+        if column == DESCRIPTION:
+            return self.description.lower()
+        return self.name.lower()
+
+
+
+
+class PackageModel(QAbstractItemModel):
+    """A flat, sortable, checkable list of packages.
+    Packages marked as changed are shown in bold through Qt.FontRole.
+    """
+
+
+    def __init__(self, parent=None):
+        QAbstractItemModel.__init__(self, parent)
+        self.rows = []
+        self.sortColumn = NAME
+        self.sortOrder = Qt.AscendingOrder
+        self.Font = QFont()
+        self.changeFont = QFont()
+        self.changeFont.setBold(True)
+
+
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.isValid() or row < 0 or row >= len(self.rows) or \
+           column < 0 or column >= len(HEADERS):
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+
+    def parent(self, index):
+        return QModelIndex()
+
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(HEADERS)
+
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == REPO:
+                return row.repo
+            if column == NAME:
+                return row.name
+            if column == DESCRIPTION:
+                return row.description
+        elif role == Qt.CheckStateRole and column == CHECK:
+            return Qt.Checked if row.checked else Qt.Unchecked
+        elif role == Qt.FontRole:
+            return self.changeFont if row.changed else self.Font
+        elif role == Qt.ToolTipRole and column == DESCRIPTION:
+            return row.description
+        return None
+
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or role != Qt.CheckStateRole or \
+           index.column() != CHECK:
+            return False
+        self.rows[index.row()].checked = (value == Qt.Checked)
+        self.emit(SIGNAL('dataChanged(QModelIndex,QModelIndex)'), index, index)
+        return True
+
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() == CHECK:
+            flags |= Qt.ItemIsUserCheckable
+        return flags
+
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole and \
+           0 <= section < len(HEADERS):
+            return HEADERS[section]
+        return None
+
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """Sort the rows, keeping selections and other persistent indexes
+        on the rows they pointed at.
+        """
+        self.sortColumn = column
+        self.sortOrder = order
+        self.emit(SIGNAL('layoutAboutToBeChanged()'))
+        old = self.persistentIndexList()
+        oldRows = [self.rows[i.row()] for i in old]
+        self.rows.sort(key=lambda r: r.key(column),
+                       reverse=(order == Qt.DescendingOrder))
+        position = dict((id(r), i) for i, r in enumerate(self.rows))
+        new = [self.index(position[id(r)], i.column())
+               for r, i in zip(oldRows, old)]
+        self.changePersistentIndexList(old, new)
+        self.emit(SIGNAL('layoutChanged()'))
+
+
+    def setRows(self, rows):
+        """Replace the contents of the list.
+        :param rows: List of PackageRow.
+        """
+        self.beginResetModel()
+        self.rows = list(rows)
+        self.rows.sort(key=lambda r: r.key(self.sortColumn),
+                       reverse=(self.sortOrder == Qt.DescendingOrder))
+        self.endResetModel()
+
+
+    def appendRows(self, rows):
+        """Add rows to the list, keeping it sorted.
+        :param rows: List of PackageRow.
+        """
+        if not rows:
+            return
+        first = len(self.rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self.rows += rows
+        self.endInsertRows()
+        self.sort(self.sortColumn, self.sortOrder)
+
+
+    def clear(self):
+        """Remove every row.
+        """
+        self.setRows([])
+
+
+    def setChanged(self, row, changed):
+        """Mark a row as changed or not, restyling only that row.
+        :param row: Row number.
+        :param changed: Whether the package is marked for a change.
+        """
+        r = self.rows[row]
+        if r.changed == changed:
+            return
+        r.changed = changed
+        self.emit(SIGNAL('dataChanged(QModelIndex,QModelIndex)'),
+                  self.index(row, REPO), self.index(row, DESCRIPTION))
+
+
+    def findName(self, name, caseSensitive=True):
+        """Returns the row number of a package, or -1.
+        """
+        if not caseSensitive:
+            name = name.lower()
+        for i, row in enumerate(self.rows):
+            if row.name == name or \
+               (not caseSensitive and row.name.lower() == name):
+                return i
+        return -1
+
+
+
+
+# vim: set ts=4 sw=4 noet:
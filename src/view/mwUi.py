@@ -54,16 +54,16 @@ class Ui_MainWindow(object):
         self.verticalLayout.addLayout(self.horizontalLayout)
         self.horizontalLayout_2 = QtGui.QHBoxLayout()
         self.horizontalLayout_2.setObjectName(_fromUtf8("horizontalLayout_2"))
-        self.queryList = QtGui.QTreeWidget(self.centralwidget)
+        self.queryList = QtGui.QTreeView(self.centralwidget)
         sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Expanding)
         sizePolicy.setHorizontalStretch(0)
         sizePolicy.setVerticalStretch(0)
         sizePolicy.setHeightForWidth(self.queryList.sizePolicy().hasHeightForWidth())
         self.queryList.setSizePolicy(sizePolicy)
+        self.queryList.setRootIsDecorated(False)
         self.queryList.setUniformRowHeights(True)
         self.queryList.setItemsExpandable(True)
         self.queryList.setAllColumnsShowFocus(False)
-        self.queryList.setColumnCount(4)
         self.queryList.setObjectName(_fromUtf8("queryList"))
         self.queryList.header().setCascadingSectionResizes(False)
         self.queryList.header().setDefaultSectionSize(75)
@@ -114,10 +114,6 @@ class Ui_MainWindow(object):
         self.queryEdit.setPlaceholderText(QtGui.QApplication.translate("MainWindow", "Cool App....", None, QtGui.QApplication.UnicodeUTF8))
         self.queryButton.setText(QtGui.QApplication.translate("MainWindow", "Search", None, QtGui.QApplication.UnicodeUTF8))
         self.queryList.setSortingEnabled(True)
-        self.queryList.headerItem().setText(0, QtGui.QApplication.translate("MainWindow", "Installed", None, QtGui.QApplication.UnicodeUTF8))
-        self.queryList.headerItem().setText(1, QtGui.QApplication.translate("MainWindow", "Repo", None, QtGui.QApplication.UnicodeUTF8))
-        self.queryList.headerItem().setText(2, QtGui.QApplication.translate("MainWindow", "Name", None, QtGui.QApplication.UnicodeUTF8))
-        self.queryList.headerItem().setText(3, QtGui.QApplication.translate("MainWindow", "Description", None, QtGui.QApplication.UnicodeUTF8))
         self.applyButton.setText(QtGui.QApplication.translate("MainWindow", "Apply", None, QtGui.QApplication.UnicodeUTF8))
         self.quitButton.setText(QtGui.QApplication.translate("MainWindow", "Quit", None, QtGui.QApplication.UnicodeUTF8))
         self.toolBar.setWindowTitle(QtGui.QApplication.translate("MainWindow", "toolBar", None, QtGui.QApplication.UnicodeUTF8))